@@ -1,16 +1,33 @@
 import logging
 
+import requests
+
 from aws.resources.handler import ResourcesHandler
-from config import get_config
+from config import get_config, clear_port_credentials_cache
+import profiling
+import telemetry
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
 def lambda_handler(event, context):
-    logger.info("Load config")
-    config = get_config(event, context)
-    logger.info("Handling resources")
-    resources_handler = ResourcesHandler(config, context)
-    resources_handler.handle()
-    logger.info("Exiting...")
+    profiler = profiling.start(event, context)
+    try:
+        logger.info("Load config")
+        with telemetry.timer('config_load'):
+            config = get_config(event, context)
+        logger.info("Handling resources")
+        resources_handler = ResourcesHandler(config, context)
+        result = resources_handler.handle()
+        logger.info("Exiting...")
+        return result
+    except requests.HTTPError as e:
+        if e.response is not None and e.response.status_code == 401:
+            # The secret may have been rotated, so the next invocation fetches the credentials again
+            clear_port_credentials_cache()
+        raise
+    finally:
+        telemetry.emit_metrics()
+        if profiler:
+            profiler.stop_and_upload()
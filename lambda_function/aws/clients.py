@@ -0,0 +1,53 @@
+import logging
+import threading
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import RefreshableCredentials
+
+import consts
+
+logger = logging.getLogger(__name__)
+
+# Clients are thread safe but sessions are not, so they are created under a lock and shared by all the workers.
+# Kept at module level to be reused across warm invocations
+_sessions = {}
+_clients = {}
+_lock = threading.RLock()
+_client_config = Config(max_pool_connections=consts.MAX_UPSERT_WORKERS * consts.MAX_CONCURRENT_SCANS)
+
+
+def get_client(service_name, region_name=None, role_arn=None):
+    client_key = (service_name, region_name, role_arn)
+    client = _clients.get(client_key)
+    if client is None:
+        with _lock:
+            client = _clients.get(client_key)
+            if client is None:
+                client = _get_session(role_arn).client(service_name, region_name=region_name, config=_client_config)
+                _clients[client_key] = client
+    return client
+
+
+def _get_session(role_arn):
+    session = _sessions.get(role_arn)
+    if session is None:
+        if role_arn:
+            botocore_session = botocore.session.get_session()
+            botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+                metadata=_assume_role(role_arn), refresh_using=lambda: _assume_role(role_arn),
+                method='sts-assume-role')
+            session = boto3.session.Session(botocore_session=botocore_session)
+        else:
+            session = boto3.session.Session()
+        _sessions[role_arn] = session
+    return session
+
+
+def _assume_role(role_arn):
+    logger.info(f"Assume role: {role_arn}")
+    credentials = get_client('sts').assume_role(RoleArn=role_arn,
+                                                RoleSessionName=consts.PORT_AWS_EXPORTER_NAME).get('Credentials')
+    return {'access_key': credentials['AccessKeyId'], 'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'], 'expiry_time': credentials['Expiration'].isoformat()}
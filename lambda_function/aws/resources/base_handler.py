@@ -1,31 +1,68 @@
 import copy
 import json
 import logging
+import queue
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
+from botocore.exceptions import BotoCoreError, ClientError
 
 import consts
+import telemetry
+from aws.resources.scheduler import get_service_name
+from concurrency import get_aws_limiter
 from port.entities import create_entities_json
+from port.entity_set import EntitySet
+from time_budget import TimeBudget
 
 logger = logging.getLogger(__name__)
 
+# Errors of a resource that doesn't exist anymore. CloudFormation tells it only in the message of a ValidationError
+RESOURCE_NOT_FOUND_ERROR_CODES = {'ResourceNotFoundException', 'NotFound', 'NoSuchEntity'}
+
+
+def is_resource_not_found_error(error):
+    if not isinstance(error, ClientError):
+        return False
+    error_info = error.response.get('Error', {})
+    return error_info.get('Code') in RESOURCE_NOT_FOUND_ERROR_CODES or (
+            error_info.get('Code') == 'ValidationError' and 'does not exist' in error_info.get('Message', ''))
+
+
+def is_retryable_resource_error(error):
+    # AWS errors may pass on a retry, unlike the errors of transforming the resource with the mappings
+    return isinstance(error, (ClientError, BotoCoreError))
+
 
 class BaseHandler:
-    def __init__(self, resource_config, port_client, lambda_context, default_region):
+    # The handle_single_resource_item argument that identifies a page item, for checkpoints in the middle of a page
+    item_id_arg = None
+
+    def __init__(self, resource_config, port_client, lambda_context, default_region, entities_cache=None,
+                 fetch_cache=None):
         self.resource_config = copy.deepcopy(resource_config)
         self.port_client = port_client
+        self.entities_cache = entities_cache
+        self.fetch_cache = fetch_cache
         self.lambda_context = lambda_context
         self.kind = self.resource_config.get('kind', '')
         selector = self.resource_config.get('selector', {})
         self.selector_query = selector.get('query')
         self.selector_aws = selector.get('aws', {})
+        # Set on the scan units of a multi account sync, the resources of other accounts are read with their roles
+        self.account_id = self.selector_aws.get('account_id')
+        self.role_arn = self.selector_aws.get('role_arn')
         self.regions = self.selector_aws.get('regions', [default_region])
         self.regions_config = self.selector_aws.get('regions_config', {})
         self.next_token = self.selector_aws.get('next_token', '')
+        self.handled_items = set(self.selector_aws.get('handled_items', []))
         self.mappings = self.resource_config.get('port', {}).get('entity', {}).get('mappings', [])
-        self.aws_entities = set()
+        self.aws_entities = EntitySet()
         self.skip_delete = False
+        self.time_budget = TimeBudget(lambda_context, self.kind)
+        self._results_lock = threading.Lock()
 
     def handle(self):
         raise NotImplementedError("Subclasses should implement 'handle' function")
@@ -33,6 +70,134 @@ class BaseHandler:
     def handle_single_resource_item(self, region, resource_id, action_type='upsert'):
         raise NotImplementedError("Subclasses should implement 'handle_single_resource_item' function")
 
+    def _handle_pages(self, region, list_page):
+        # Streams the resources of all the pages, starting from self.next_token, to long-lived workers, while the
+        # next pages are listed ahead. list_page(next_token) returns the page items, as kwargs for
+        # handle_single_resource_item, and the next token.
+        # Returns False when the time budget can't fit the next page or item, the first item is always handled so
+        # every run makes progress. Items in flight are always completed before returning, so self.next_token is
+        # exactly the first page that wasn't fully handled, and self.handled_items are the ids of its items that were.
+        pages = queue.Queue(maxsize=consts.PREFETCH_PAGES)
+        stop_listing = threading.Event()
+        threading.Thread(target=self._list_pages, args=(region, list_page, self.next_token, pages, stop_listing),
+                         daemon=True).start()
+        in_flight = threading.BoundedSemaphore(consts.MAX_IN_FLIGHT_ITEMS)
+        in_flight_count = [0]
+
+        def handle_item(item):
+            start_time = time.monotonic()
+            try:
+                with telemetry.scope(self.kind, region):
+                    return self.handle_single_resource_item(region, **item)
+            finally:
+                self.time_budget.item_latency.update(time.monotonic() - start_time)
+
+        def on_item_done(future):
+            in_flight.release()
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"Failed to handle resource of kind: {self.kind}, region: {region}; {e}")
+                result = {'skip_delete': True}
+            with self._results_lock:
+                in_flight_count[0] -= 1
+                self.aws_entities.update(result.get('aws_entities', set()))
+                self.skip_delete = self.skip_delete or result.get('skip_delete', False)
+
+        completed = True
+        started = False
+        with ThreadPoolExecutor(max_workers=consts.MAX_UPSERT_WORKERS) as executor:
+            while self.next_token is not None:
+                if started and not self.time_budget.can_start_page(in_flight_count[0]):
+                    completed = False
+                    break
+
+                page = pages.get()
+                if isinstance(page, Exception):
+                    with self._results_lock:
+                        self.skip_delete = True
+                    self.next_token = None
+                    self.handled_items = set()
+                    break
+
+                items, next_token = page
+                for item in items:
+                    item_id = item.get(self.item_id_arg) if self.item_id_arg else None
+                    if item_id is not None and item_id in self.handled_items:  # Handled by a previous run, that stopped in this page
+                        continue
+                    in_flight.acquire()
+                    with self._results_lock:
+                        completed = not started or self.time_budget.can_start_item(in_flight_count[0])
+                        if completed:
+                            in_flight_count[0] += 1
+                    if not completed:
+                        in_flight.release()
+                        break
+                    started = True
+                    executor.submit(handle_item, item).add_done_callback(on_item_done)
+                    if item_id is not None:
+                        self.handled_items.add(item_id)
+                if not completed:
+                    break
+                self.next_token = next_token
+                self.handled_items = set()
+
+        stop_listing.set()
+        return completed
+
+    def _list_pages(self, region, list_page, next_token, pages, stop_listing):
+        while not stop_listing.is_set():
+            start_time = time.monotonic()
+            try:
+                with telemetry.scope(self.kind, region), telemetry.timer('list'):
+                    page = list_page(next_token)
+                next_token = page[1]
+                self.time_budget.page_latency.update(time.monotonic() - start_time)
+            except Exception as e:
+                page = e
+            while not stop_listing.is_set():
+                try:
+                    pages.put(page, timeout=1)
+                    break
+                except queue.Full:
+                    continue
+            if isinstance(page, Exception) or next_token is None:
+                return
+
+    def _get_aws_limiter(self, region):
+        return get_aws_limiter(get_service_name(self.kind), region, self.account_id)
+
+    def _fetch(self, key, fetch, get_size):
+        # Fetches that are shared with other resource configs of the same kind go through the run fetch cache
+        if self.fetch_cache is None:
+            return fetch()
+        return self.fetch_cache.get_or_fetch((self.kind, self.account_id, *key), fetch, get_size)
+
+    def get_scan_units(self):
+        # Splits the resource config into independent resource configs that can be scanned concurrently.
+        # A next token and handled items from a checkpoint belong to the first unit, as regions are scanned by order
+        scan_units = []
+        for region in self.regions:
+            for region_config in self._get_region_scan_units_config(region):
+                next_token, handled_items = (None, None) if scan_units else (self.next_token, self.handled_items)
+                scan_units.append(self._create_scan_unit(region, region_config, next_token, handled_items))
+        return scan_units
+
+    def _get_region_scan_units_config(self, region):
+        return [self.regions_config.get(region)]
+
+    def _create_scan_unit(self, region, region_config, next_token, handled_items):
+        selector_aws = {k: v for k, v in self.selector_aws.items() if
+                        k not in ['next_token', 'handled_items', 'regions_config']}
+        selector_aws['regions'] = [region]
+        if region_config is not None:
+            selector_aws['regions_config'] = {region: region_config}
+        if next_token:
+            selector_aws['next_token'] = next_token
+        if handled_items:
+            selector_aws['handled_items'] = list(handled_items)
+        return {**self.resource_config, 'selector': {**self.resource_config.get('selector', {}), 'aws': selector_aws}}
+
     def _cleanup_regions(self, region):
         self.regions.remove(region)
         self.regions_config.pop(region, None)
@@ -1,44 +1,40 @@
-import copy
+import functools
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
-from aws.resources.base_handler import BaseHandler
-import consts
-from port.entities import create_entities_json, handle_entities
+from aws.clients import get_client
+from aws.resources.base_handler import BaseHandler, is_resource_not_found_error, is_retryable_resource_error
+import telemetry
+from concurrency import call_aws
+from port.client import is_retryable_port_error
+from port.entities import create_entities_json, handle_entities, get_mappings_queries, get_jq_referenced_paths, \
+    has_jq_referenced_paths
 
 logger = logging.getLogger(__name__)
 
 
 class CloudControlHandler(BaseHandler):
+    item_id_arg = 'resource_id'
+
+    def __init__(self, resource_config, port_client, lambda_context, default_region, entities_cache=None,
+                 fetch_cache=None):
+        super().__init__(resource_config, port_client, lambda_context, default_region, entities_cache, fetch_cache)
+        # Where the resource properties are taken from: 'list' - the ListResources response, 'get' - GetResource
+        # per resource, 'auto' - the ListResources response if it has all the paths the selector and mappings read
+        self.properties_source = self.selector_aws.get('properties_source', 'auto')
+        self.referenced_paths = get_jq_referenced_paths(get_mappings_queries(self.selector_query, self.mappings))
+
     def handle(self):
         for region in list(self.regions):
-            aws_cloudcontrol_client = boto3.client('cloudcontrol', region_name=region)
+            aws_cloudcontrol_client = get_client('cloudcontrol', region_name=region, role_arn=self.role_arn)
             resources_models = self.regions_config.get(region, {}).get('resources_models', ["{}"])
             for resource_model in list(resources_models):
                 logger.info(f"List kind: {self.kind}, region: {region}, resource_model: {resource_model}")
                 self.next_token = '' if self.next_token is None else self.next_token
-                while self.next_token is not None:
-                    list_resources_params = {'TypeName': self.kind, 'ResourceModel': resource_model}
-                    if self.next_token:
-                        list_resources_params['NextToken'] = self.next_token
-
-                    try:
-                        response = aws_cloudcontrol_client.list_resources(**list_resources_params)
-                    except Exception as e:
-                        logger.error(
-                            f"Failed list kind: {self.kind}, region: {region}, resource_model: {resource_model}; {e}")
-                        self.skip_delete = True
-                        self.next_token = None
-                        break
-
-                    self._handle_list_response(response, region)
-
-                    self.next_token = response.get('NextToken')
-                    if self.lambda_context.get_remaining_time_in_millis() < consts.REMAINING_TIME_TO_REINVOKE_THRESHOLD:
-                        # Lambda timeout is too close, should return checkpoint for next run
-                        return self._handle_close_to_timeout(resources_models, resource_model, region)
+                list_page = functools.partial(self._list_resources_page, aws_cloudcontrol_client, region,
+                                              resource_model)
+                if not self._handle_pages(region, list_page):
+                    return self._handle_close_to_timeout(resources_models, resource_model, region)
 
                 self._cleanup_resources_models(resources_models, resource_model, region)
 
@@ -46,43 +42,83 @@ class CloudControlHandler(BaseHandler):
 
         return {'aws_entities': self.aws_entities, 'next_resource_config': None, 'skip_delete': self.skip_delete}
 
-    def _handle_list_response(self, list_response, region):
-        resource_descriptions = list_response.get('ResourceDescriptions', [])
-        with ThreadPoolExecutor(max_workers=consts.MAX_UPSERT_WORKERS) as executor:
-            futures = [executor.submit(self.handle_single_resource_item, region,
-                                       resource_desc.get('Identifier', '')) for resource_desc in resource_descriptions]
-            for completed_future in as_completed(futures):
-                result = completed_future.result()
-                self.aws_entities.update(result.get('aws_entities', set()))
-                self.skip_delete = result.get('skip_delete', False) if not self.skip_delete else self.skip_delete
-
-    def handle_single_resource_item(self, region, resource_id, action_type='upsert'):
+    def _get_region_scan_units_config(self, region):
+        region_config = self.regions_config.get(region, {})
+        return [{**region_config, 'resources_models': [resource_model]} for resource_model in
+                region_config.get('resources_models', ["{}"])]
+
+    def _list_resources_page(self, aws_cloudcontrol_client, region, resource_model, next_token):
+        list_resources_params = {'TypeName': self.kind, 'ResourceModel': resource_model}
+        if next_token:
+            list_resources_params['NextToken'] = next_token
+        try:
+            response = self._fetch(('list', region, resource_model, next_token),
+                                    lambda: call_aws(self._get_aws_limiter(region),
+                                                     aws_cloudcontrol_client.list_resources, **list_resources_params),
+                                    _get_list_response_size)
+        except Exception as e:
+            logger.error(f"Failed list kind: {self.kind}, region: {region}, resource_model: {resource_model}; {e}")
+            raise
+
+        return [{'resource_id': resource_desc.get('Identifier', ''), 'list_properties': resource_desc.get('Properties')}
+                for resource_desc in response.get('ResourceDescriptions', [])], response.get('NextToken')
+
+    def handle_single_resource_item(self, region, resource_id, action_type='upsert', list_properties=None):
         entities = []
         skip_delete = False
+        retry = False  # Whether a failure may pass when the resource is handled again
         try:
             resource_obj = {}
             if action_type == 'upsert':
-                logger.info(f"Get resource for kind: {self.kind}, resource id: {resource_id}")
-                aws_cloudcontrol_client = boto3.client("cloudcontrol", region_name=region)
-                resource_obj = json.loads(aws_cloudcontrol_client.get_resource(TypeName=self.kind,
-                                                                               Identifier=resource_id).get(
-                    'ResourceDescription').get('Properties'))
+                resource_obj = self._get_list_resource_obj(list_properties)
+            if action_type == 'upsert' and resource_obj is None:
+                if telemetry.should_log_entity():
+                    logger.info(f"Get resource for kind: {self.kind}, resource id: {resource_id}")
+                aws_cloudcontrol_client = get_client("cloudcontrol", region_name=region, role_arn=self.role_arn)
+                with telemetry.timer('get'):
+                    resource_obj = json.loads(self._fetch(
+                        ('get', region, resource_id),
+                        lambda: call_aws(self._get_aws_limiter(region), aws_cloudcontrol_client.get_resource,
+                                         TypeName=self.kind, Identifier=resource_id).get(
+                            'ResourceDescription').get('Properties'), len))
             elif action_type == 'delete':
                 resource_obj = {"identifier": resource_id}  # Entity identifier to delete
-            entities = create_entities_json(resource_obj, self.selector_query, self.mappings, action_type)
+            with telemetry.timer('transform'):
+                entities = create_entities_json(resource_obj, self.selector_query, self.mappings, action_type)
         except Exception as e:
-            logger.error(f"Failed to extract or transform resource id: {resource_id}, kind: {self.kind}, error: {e}")
-            skip_delete = True
-
-        aws_entities = handle_entities(entities, self.port_client, action_type)
-
-        return {'aws_entities': aws_entities, 'skip_delete': skip_delete}
+            if is_resource_not_found_error(e):
+                # Deleted since it was listed or since the event was sent, its entity is deleted as stale or by its
+                # delete event
+                logger.info(f"Resource id: {resource_id}, kind: {self.kind} doesn't exist anymore")
+            else:
+                logger.error(
+                    f"Failed to extract or transform resource id: {resource_id}, kind: {self.kind}, error: {e}")
+                skip_delete = True
+                retry = is_retryable_resource_error(e)
+
+        aws_entities, failed_entities = handle_entities(entities, self.port_client, action_type, self.entities_cache)
+        retry = retry or any(is_retryable_port_error(error) for error in failed_entities.values())
+
+        return {'aws_entities': aws_entities, 'skip_delete': skip_delete, 'failed_entities': failed_entities,
+                'retry': retry}
+
+    def _get_list_resource_obj(self, list_properties):
+        # Returns None when the resource should be fetched with GetResource
+        if not list_properties or self.properties_source == 'get' or (
+                self.properties_source == 'auto' and self.referenced_paths is None):
+            return None
+        resource_obj = json.loads(list_properties)
+        if self.properties_source == 'auto' and not has_jq_referenced_paths(resource_obj, self.referenced_paths):
+            return None
+        return resource_obj
 
     def _handle_close_to_timeout(self, resources_models, current_resource_model, region):
-        if self.next_token:
+        if self.next_token is not None:  # An empty token is the first page
             self.selector_aws['next_token'] = self.next_token
+            self.selector_aws['handled_items'] = list(self.handled_items)
         else:
             self.selector_aws.pop('next_token', None)
+            self.selector_aws.pop('handled_items', None)
             resources_models = self._cleanup_resources_models(resources_models, current_resource_model, region)
             if not resources_models:
                 self._cleanup_regions(region)
@@ -104,3 +140,8 @@ class CloudControlHandler(BaseHandler):
         self.regions_config[region]['resources_models'] = resources_models
         self.selector_aws['regions_config'] = self.regions_config
         return resources_models
+
+
+def _get_list_response_size(response):
+    return sum(len(resource_desc.get('Identifier', '')) + len(resource_desc.get('Properties') or '')
+               for resource_desc in response.get('ResourceDescriptions', []))
@@ -1,79 +1,105 @@
+import functools
 import json
 import logging
 from collections import OrderedDict
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
-import boto3
-import consts
-import yaml
-from aws.resources.base_handler import BaseHandler
-from port.entities import create_entities_json, handle_entities
+from aws.clients import get_client
+from aws.resources.base_handler import BaseHandler, is_resource_not_found_error, is_retryable_resource_error
+import telemetry
+from concurrency import call_aws
+from port.client import is_retryable_port_error
+from port.entities import create_entities_json, handle_entities, get_mappings_queries, get_jq_referenced_fields
 
 logger = logging.getLogger(__name__)
 
 
 class CloudFormationHandler(BaseHandler):
+    item_id_arg = 'stack_id'
+
+    def __init__(self, resource_config, port_client, lambda_context, default_region, entities_cache=None,
+                 fetch_cache=None):
+        super().__init__(resource_config, port_client, lambda_context, default_region, entities_cache, fetch_cache)
+        # Stacks are listed with their details by describe_stacks. Checkpoints from before were saved with a
+        # list_stacks next token, so they keep using it until the region is done
+        self.list_api = self.selector_aws.get('list_api', 'list_stacks') if self.next_token else 'describe_stacks'
+        # Stack resources and template cost an API call each per stack, so fetch them only when they are used
+        referenced_fields = get_jq_referenced_fields(get_mappings_queries(self.selector_query, self.mappings))
+        self.fetch_stack_resources = referenced_fields is None or 'StackResources' in referenced_fields
+        self.fetch_template = referenced_fields is None or 'TemplateBody' in referenced_fields
+
     def handle(self):
         for region in list(self.regions):
-            aws_cloudformation_client = boto3.client('cloudformation', region_name=region)
+            aws_cloudformation_client = get_client('cloudformation', region_name=region, role_arn=self.role_arn)
             logger.info(f"List CloudFormation Stack, region: {region}")
             self.next_token = '' if self.next_token is None else self.next_token
-            while self.next_token is not None:
-                list_stacks_params = self.selector_aws.get('list_parameters', {})
-                if self.next_token:
-                    list_stacks_params['NextToken'] = self.next_token
-                try:
-                    response = aws_cloudformation_client.list_stacks(**list_stacks_params)
-                except Exception as e:
-                    logger.error(
-                        f"Failed list CloudFormation Stack, region: {region},"
-                        f" Parameters: {list_stacks_params}; {e}")
-                    self.skip_delete = True
-                    self.next_token = None
-                    break
-
-                self._handle_list_response(response, region)
-
-                self.next_token = response.get('NextToken')
-                if self.lambda_context.get_remaining_time_in_millis() < consts.REMAINING_TIME_TO_REINVOKE_THRESHOLD:
-                    # Lambda timeout is too close, should return checkpoint for next run
-                    return self._handle_close_to_timeout(region)
+            list_page = self._list_stacks_page if self.list_api == 'list_stacks' else self._describe_stacks_page
+            if not self._handle_pages(region, functools.partial(list_page, aws_cloudformation_client, region)):
+                return self._handle_close_to_timeout(region)
 
+            self.list_api = 'describe_stacks'
             self._cleanup_regions(region)
 
         return {'aws_entities': self.aws_entities, 'next_resource_config': None, 'skip_delete': self.skip_delete}
 
-    def _handle_list_response(self, list_response, region):
-        stacks = list_response.get('StackSummaries', [])
-        with ThreadPoolExecutor(max_workers=consts.MAX_UPSERT_WORKERS) as executor:
-            futures = [executor.submit(self.handle_single_resource_item, region, stack.get("StackId")) for stack in
-                       stacks if stack['StackStatus'] != 'DELETE_COMPLETE']
-            for completed_future in as_completed(futures):
-                result = completed_future.result()
-                self.aws_entities.update(result.get('aws_entities', set()))
-                self.skip_delete = result.get('skip_delete', False) if not self.skip_delete else self.skip_delete
-
-    def handle_single_resource_item(self, region, stack_id, action_type='upsert'):
+    def _list_stacks_page(self, aws_cloudformation_client, region, next_token):
+        list_stacks_params = {**self.selector_aws.get('list_parameters', {})}
+        if next_token:
+            list_stacks_params['NextToken'] = next_token
+        try:
+            response = call_aws(self._get_aws_limiter(region), aws_cloudformation_client.list_stacks,
+                                **list_stacks_params)
+        except Exception as e:
+            logger.error(f"Failed list CloudFormation Stack, region: {region}, Parameters: {list_stacks_params}; {e}")
+            raise
+
+        return [{'stack_id': stack.get("StackId")} for stack in response.get('StackSummaries', []) if
+                stack['StackStatus'] != 'DELETE_COMPLETE'], response.get('NextToken')
+
+    def _describe_stacks_page(self, aws_cloudformation_client, region, next_token):
+        describe_stacks_params = {'NextToken': next_token} if next_token else {}
+        try:
+            response = call_aws(self._get_aws_limiter(region), aws_cloudformation_client.describe_stacks,
+                                **describe_stacks_params)
+        except Exception as e:
+            logger.error(f"Failed describe CloudFormation Stacks, region: {region}; {e}")
+            raise
+
+        # describe_stacks has no status filter, so the list_stacks one is applied here
+        status_filter = self.selector_aws.get('list_parameters', {}).get('StackStatusFilter')
+        return [{'stack_id': stack.get("StackId"), 'stack': stack} for stack in response.get('Stacks', []) if
+                stack['StackStatus'] != 'DELETE_COMPLETE' and (
+                        not status_filter or stack['StackStatus'] in status_filter)], response.get('NextToken')
+
+    def handle_single_resource_item(self, region, stack_id, action_type='upsert', stack=None):
         entities = []
         skip_delete = False
+        retry = False  # Whether a failure may pass when the stack is handled again
         try:
             stack_obj = {}
             if action_type == 'upsert':
-                logger.info(f"Get CloudFormation Stack, id: {stack_id}")
-
-                aws_cloudformation_client = boto3.client("cloudformation", region_name=region)
-                stack_obj = aws_cloudformation_client.describe_stacks(StackName=stack_id).get("Stacks")[0]
-                stack_obj['StackResources'] = aws_cloudformation_client.describe_stack_resources(
-                    StackName=stack_id).get('StackResources')
-                template = aws_cloudformation_client.get_template(StackName=stack_id).get(
-                    'TemplateBody')
-
-                # Some templates return as nested OrderedDict, so we need to convert them
-                # to regular dicts using the json library and then to yaml strings for a clear yaml
-                if isinstance(template, OrderedDict):
-                    template = yaml.dump(json.loads(json.dumps(template)))
-
-                stack_obj['TemplateBody'] = template
+                if telemetry.should_log_entity():
+                    logger.info(f"Get CloudFormation Stack, id: {stack_id}")
+
+                aws_cloudformation_client = get_client("cloudformation", region_name=region, role_arn=self.role_arn)
+                aws_limiter = self._get_aws_limiter(region)
+                with telemetry.timer('get'):
+                    stack_obj = stack or call_aws(aws_limiter, aws_cloudformation_client.describe_stacks,
+                                                  StackName=stack_id).get("Stacks")[0]
+                    if self.fetch_stack_resources:
+                        stack_obj['StackResources'] = call_aws(aws_limiter,
+                                                               aws_cloudformation_client.describe_stack_resources,
+                                                               StackName=stack_id).get('StackResources')
+                    template = call_aws(aws_limiter, aws_cloudformation_client.get_template,
+                                        StackName=stack_id).get('TemplateBody') if self.fetch_template else None
+                if self.fetch_template:
+
+                    # Some templates return as nested OrderedDict, so we need to convert them
+                    # to regular dicts using the json library and then to yaml strings for a clear yaml
+                    if isinstance(template, OrderedDict):
+                        import yaml  # Imported on use, as it slows down the start of every other invocation
+                        template = yaml.dump(json.loads(json.dumps(template)))
+
+                    stack_obj['TemplateBody'] = template
 
                 # Handles unserializable date properties in the JSON by turning them into a string
                 stack_obj = json.loads(json.dumps(stack_obj, default=str))
@@ -81,21 +107,34 @@ class CloudFormationHandler(BaseHandler):
             elif action_type == 'delete':
                 stack_obj = {"identifier": stack_id}  # Entity identifier to delete
 
-            entities = create_entities_json(stack_obj, self.selector_query, self.mappings, action_type)
+            with telemetry.timer('transform'):
+                entities = create_entities_json(stack_obj, self.selector_query, self.mappings, action_type)
 
         except Exception as e:
-            logger.error(f"Failed to extract or transform CloudFormation Stack with id: {stack_id}, error: {e}")
-            skip_delete = True
+            if is_resource_not_found_error(e):
+                # Deleted since it was listed or since the event was sent, its entity is deleted as stale or by its
+                # delete event
+                logger.info(f"CloudFormation Stack with id: {stack_id} doesn't exist anymore")
+            else:
+                logger.error(f"Failed to extract or transform CloudFormation Stack with id: {stack_id}, error: {e}")
+                skip_delete = True
+                retry = is_retryable_resource_error(e)
 
-        aws_entities = handle_entities(entities, self.port_client, action_type)
+        aws_entities, failed_entities = handle_entities(entities, self.port_client, action_type, self.entities_cache)
+        retry = retry or any(is_retryable_port_error(error) for error in failed_entities.values())
 
-        return {'aws_entities': aws_entities, 'skip_delete': skip_delete}
+        return {'aws_entities': aws_entities, 'skip_delete': skip_delete, 'failed_entities': failed_entities,
+                'retry': retry}
 
     def _handle_close_to_timeout(self, region):
-        if self.next_token:
+        if self.next_token is not None:  # An empty token is the first page
             self.selector_aws['next_token'] = self.next_token
+            self.selector_aws['handled_items'] = list(self.handled_items)
+            self.selector_aws['list_api'] = self.list_api
         else:
             self.selector_aws.pop('next_token', None)
+            self.selector_aws.pop('handled_items', None)
+            self.selector_aws.pop('list_api', None)
             self._cleanup_regions(region)
             if not self.regions:  # Nothing left to sync
                 return {'aws_entities': self.aws_entities, 'next_resource_config': None,
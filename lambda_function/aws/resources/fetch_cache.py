@@ -0,0 +1,68 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class FetchCache:
+    # Run scoped LRU cache of fetched list pages and resource properties, for kinds that are used by several resource
+    # configs. Concurrent fetches of the same key wait for the first one instead of calling AWS again
+    def __init__(self, kinds, max_size):
+        self.kinds = set(kinds)
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_or_fetch(self, key, fetch, get_size):
+        # key must start with the kind
+        if key[0] not in self.kinds:
+            return fetch()
+
+        while True:
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._entries[key][0]
+                fetch_done = self._in_flight.get(key)
+                if fetch_done is None:
+                    self.misses += 1
+                    fetch_done = self._in_flight[key] = threading.Event()
+                    break
+            fetch_done.wait()
+            with self._lock:
+                if key not in self._entries:  # The fetch failed or was already evicted, fetch it here
+                    self.misses += 1
+                    return fetch()
+
+        try:
+            value = fetch()
+            self._put(key, value, get_size(value))
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key).set()
+
+    def _put(self, key, value, size):
+        with self._lock:
+            if size > self.max_size:
+                return
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def log_stats(self):
+        if self.kinds:
+            logger.info(f"Fetch cache stats, kinds: {len(self.kinds)}, hits: {self.hits}, misses: {self.misses},"
+                        f" evictions: {self.evictions}, size: {self.size} bytes")
@@ -1,13 +1,25 @@
 import json
 import logging
-from concurrent.futures import ThreadPoolExecutor
-
-import boto3
-import jq
+import os
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import consts
-from aws.resources.handler_creator import create_resource_handler
+import telemetry
+from aws.clients import get_client
+from aws.resources.fetch_cache import FetchCache
+from aws.resources.handler_creator import create_resource_handler, SPECIAL_AWS_HANDLERS
+from aws.resources.scheduler import ScanScheduler
+from capability_catalog import load_catalog, get_unsupported_reason
+from checkpoint import save_entities_checkpoint, load_entities_checkpoint
+from concurrency import log_limiters
+from fan_out import shard_scan_units, save_config, get_shard_config_key, get_reduce_config_key, \
+    save_shard_result, count_finished_shards, claim_reduce, load_shard_results, cleanup_run
 from port.client import PortClient
+from port.entities import run_jq_query, get_mapping_blueprint
+from port.entity_set import EntitySet
+from port.entities_cache import EntitiesCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,32 +30,54 @@ class ResourcesHandler:
         self.lambda_context = lambda_context
         split_arn = lambda_context.invoked_function_arn.split(':')
         self.region = split_arn[3]
-        account_id = split_arn[4]
-        self.user_id = f"accountid/{account_id} region/{self.region}"
+        self.account_id = split_arn[4]
+        self.user_id = self._get_user_id(self.account_id)
         port_client_id = self.config.get('port_client_id') if self.config.get('keep_cred') else self.config.pop(
             'port_client_id')
         port_client_secret = self.config.get('port_client_secret') if self.config.get('keep_cred') else self.config.pop(
             'port_client_secret')
-        self.port_client = PortClient(port_client_id, port_client_secret,
-                                      user_agent=f"{consts.PORT_AWS_EXPORTER_NAME}/0.1 ({self.user_id})",
-                                      api_url=self.config.get('port_api_url', consts.PORT_API_URL))
+        self.port_client = self._create_port_client(port_client_id, port_client_secret, self.user_id)
+        # Accounts of a multi account sync by their id, with the roles to assume in them. The entities of every
+        # account are upserted with its own user agent, so their datasource tells which account they came from
+        self.accounts = {account['id']: account.get('role_arn') for account in self.config.get('accounts', [])}
+        self.account_port_clients = {
+            account_id: self.port_client if account_id == self.account_id else self._create_port_client(
+                port_client_id, port_client_secret, self._get_user_id(account_id)) for account_id in self.accounts}
         self.event = self.config.get('event')
+        telemetry.set_entity_log_sample_rate(self.config.get('entity_log_sample_rate', 1))
         self.bucket_name = self.config['bucket_name']
         self.next_config_file_key = self.config.get('next_config_file_key')
-        self.aws_entities = set(self.config.get('aws_entities', []))
         self.resources_config = self.config['resources']
+        # The blueprints that stale entities are searched in. Kept in the config, as a re-invoked Lambda, a shard and
+        # the reducer are given only the resources that are left
+        self.config.setdefault('mappings_blueprints', sorted({
+            get_mapping_blueprint(mapping) for resource_config in self.resources_config if resource_config
+            for mapping in resource_config.get('port', {}).get('entity', {}).get('mappings', [])}))
         self.skip_delete = self.config.get('skip_delete', False)
+        self.skip_delete_accounts = set(self.config.get('skip_delete_accounts', []))
+        self.aws_entities = self._load_aws_entities()
         self.require_reinvoke = False
+        self.entities_cache = self._load_entities_cache()
+        self.resources_config_by_kind = defaultdict(list)
+        for resource_config_index, resource_config in enumerate(self.resources_config):
+            self.resources_config_by_kind[resource_config['kind']].append(resource_config_index)
+        self.fetch_cache = FetchCache([kind for kind, resource_config_indexes in self.resources_config_by_kind.items()
+                                       if len(resource_config_indexes) > 1], consts.FETCH_CACHE_MAX_SIZE)
+        self._event_handlers = {}
+        self._event_handlers_lock = threading.Lock()
 
     def handle(self):
         if self.event and self.event.get('Records'):  # Single events from SQS
             logger.info("Handle events from sqs")
-            for record in self.event.get('Records'):
-                try:
-                    resource = json.loads(record["body"])
-                    self._handle_event_resource(resource)
-                except Exception as e:
-                    logger.error(f"Failed to handle event: {self.event}, error: {e}")
+            batch_item_failures = self._handle_events(self.event.get('Records'))
+            self._log_stats()
+            return {'batchItemFailures': batch_item_failures}
+
+        if 'fan_out_reduce' in self.config:  # All the shards of a fan out sync have finished
+            self._reduce_shards()
+            return
+
+        if self._is_fan_out_coordinator() and self._fan_out():
             return
 
         logger.info("Starting upsert of AWS resources to Port")
@@ -51,76 +85,445 @@ class ResourcesHandler:
         self._upsert_resources()
 
         if self.require_reinvoke:
-            return self._reinvoke_lambda()
+            self._log_stats()
+            if self.entities_cache:
+                self.entities_cache.save()
+            self._reinvoke_lambda()
+            return
 
         logger.info("Done upsert of AWS resources to Port")
 
+        if 'fan_out_shard' in self.config:  # Stale resources are deleted by the reducer, once every shard has finished
+            self._complete_shard()
+            self._log_stats()
+            return
+
         if not self.skip_delete:
             logger.info("Starting delete process of stale resources from Port")
             self._delete_stale_resources()
             logger.info("Done deleting stale resources from Port")
 
+        self._log_stats()
+        if self.entities_cache:
+            self.entities_cache.complete(self.aws_entities)
         logger.info("Done handling your resources")
 
-    def _handle_event_resource(self, resource):
+    def _get_user_id(self, account_id):
+        return f"accountid/{account_id} region/{self.region}"
+
+    def _create_port_client(self, port_client_id, port_client_secret, user_id):
+        return PortClient(port_client_id, port_client_secret,
+                          user_agent=f"{consts.PORT_AWS_EXPORTER_NAME}/0.1 ({user_id})",
+                          api_url=self.config.get('port_api_url', consts.PORT_API_URL),
+                          bulk_upsert=self._is_bulk_upsert_enabled())
+
+    def _get_port_client(self, account_id):
+        return self.account_port_clients.get(account_id, self.port_client)
+
+    def _get_account_resources(self, resource_config):
+        # Copies the resource config to every account of a multi account sync. The account is kept in its scan units,
+        # so a re-invoked Lambda continues every account from where it stopped
+        if not self.accounts or 'account_id' in resource_config.get('selector', {}).get('aws', {}):
+            return [resource_config]
+        return [self._get_account_resource(resource_config, account_id) for account_id in self.accounts]
+
+    def _get_account_resource(self, resource_config, account_id):
+        selector = resource_config.get('selector', {})
+        return {**resource_config, 'selector': {**selector, 'aws': {
+            **selector.get('aws', {}), 'account_id': account_id, 'role_arn': self.accounts[account_id]}}}
+
+    def _get_scan_units(self):
+        scan_units = [scan_unit for resource in self.resources_config if resource
+                      for account_resource in self._get_account_resources(resource)
+                      for scan_unit in create_resource_handler(account_resource, self.port_client, self.lambda_context,
+                                                               self.region).get_scan_units()]
+        if not self.config.get('capability_catalog', {}).get('enabled', True):
+            return scan_units
+        return self._filter_unsupported_scan_units(scan_units)
+
+    def _filter_unsupported_scan_units(self, scan_units):
+        # Kinds that the capability catalog knows CloudControl can't list are skipped before any API call, instead of
+        # failing the sync. Kinds that the catalog doesn't know are scanned last, after the ones known to work
+        known_scan_units = []
+        unknown_scan_units = []
+        for scan_unit in scan_units:
+            if scan_unit['kind'] in SPECIAL_AWS_HANDLERS:
+                known_scan_units.append(scan_unit)
+                continue
+            selector_aws = scan_unit['selector']['aws']
+            region = selector_aws.get('regions', [self.region])[0]
+            catalog = load_catalog(self.bucket_name, self.config['capability_catalog_dir_key'], region)
+            if catalog is None:
+                known_scan_units.append(scan_unit)
+                continue
+            if scan_unit['kind'] not in catalog:
+                unknown_scan_units.append(scan_unit)
+                continue
+            resource_model = selector_aws.get('regions_config', {}).get(region, {}).get('resources_models', ["{}"])[0]
+            unsupported_reason = get_unsupported_reason(catalog[scan_unit['kind']], resource_model)
+            if unsupported_reason:
+                # The entities of the kind weren't seen, so they must not be deleted as stale
+                logger.warning(f"Skipping kind: {scan_unit['kind']}, region: {region}, resource_model:"
+                               f" {resource_model}, {unsupported_reason}, keeping the stale entities")
+                self._update_skip_delete(selector_aws.get('account_id'), True)
+                continue
+            known_scan_units.append(scan_unit)
+        return known_scan_units + unknown_scan_units
+
+    def _log_stats(self):
+        for port_client in {self.port_client, *self.account_port_clients.values()}:
+            port_client.log_stats()
+        log_limiters()
+        self.fetch_cache.log_stats()
+        if self.entities_cache:
+            self.entities_cache.log_stats()
+
+    def _load_aws_entities(self):
+        aws_entities = EntitySet(self.config.pop('aws_entities', []))  # Checkpoint of the legacy format
+        checkpoint_file_key = self.config.pop('aws_entities_checkpoint_file_key', None)
+        if checkpoint_file_key:
+            try:
+                aws_entities.update(load_entities_checkpoint(self.bucket_name, checkpoint_file_key))
+            except Exception as e:
+                logger.warning(
+                    f"Failed to load entities checkpoint, bucket: {self.bucket_name}, key: {checkpoint_file_key}; {e}")
+                self.skip_delete = True
+        return aws_entities
+
+    def _load_entities_cache(self):
+        entities_cache_config = self.config.get('entities_cache', {})
+        # Not used for events from SQS or fan out syncs, as they are handled concurrently and would race on the cache
+        if not entities_cache_config.get('enabled') or (self.event and self.event.get('Records')) or \
+                self.config.get('fan_out', {}).get('enabled'):
+            return None
+
+        entities_cache = EntitiesCache(self.bucket_name, self.config['entities_cache_file_key'],
+                                       entities_cache_config.get('full_resync_interval_hours',
+                                                                 consts.ENTITIES_CACHE_FULL_RESYNC_INTERVAL_HOURS))
+        entities_cache.load(is_new_sync=not (self.event or {}).get('next_config_file_key'))
+        return entities_cache
+
+    def _handle_events(self, records):
+        # Events of the same resource are collapsed to the latest one, and the resources are handled concurrently.
+        # Returns the messages that failed and may pass on a retry, so only they are redelivered
+        resources_events = {}
+        for record_index, record in enumerate(records):
+            try:
+                kind, account_id, region, identifier, action_type = self._parse_event_resource(
+                    json.loads(record["body"]))
+            except Exception as e:
+                # Invalid events would fail on every delivery, so they are not redelivered
+                logger.error(f"Failed to handle event: {record}, error: {e}")
+                continue
+            event_order = (int(record.get('attributes', {}).get('SentTimestamp', 0)), record_index)
+            resource_events = resources_events.setdefault((kind, account_id, region, identifier),
+                                                          {'order': event_order, 'message_ids': []})
+            resource_events['message_ids'].append(record.get('messageId'))
+            if event_order >= resource_events['order']:
+                resource_events.update(order=event_order, action_type=action_type)
+
+        logger.info(f"Handle {len(resources_events)} resources from {len(records)} events")
+        batch_item_failures = []
+        with ThreadPoolExecutor(max_workers=consts.MAX_UPSERT_WORKERS) as executor:
+            futures = {executor.submit(self._handle_event_resource, *resource_key, resource_events['action_type']):
+                       resource_events['message_ids'] for resource_key, resource_events in resources_events.items()}
+            for completed_future in as_completed(futures):
+                try:
+                    succeeded = completed_future.result()
+                except Exception as e:
+                    logger.error(f"Failed to handle event resource; {e}")
+                    succeeded = False
+                if not succeeded:
+                    batch_item_failures.extend({'itemIdentifier': message_id} for message_id in futures[completed_future])
+
+        return batch_item_failures
+
+    def _parse_event_resource(self, resource):
         assert 'identifier' in resource, "Event must include 'identifier'"
         assert 'region' in resource, "Event must include 'region'"
-        region = jq.first(resource['region'], resource)
-        identifier = jq.first(resource['identifier'], resource)
+        region = run_jq_query(resource['region'], resource)
+        identifier = run_jq_query(resource['identifier'], resource)
+        # Events of a multi account sync tell the account of the resource, otherwise it's the Lambda's account
+        account_id = str(run_jq_query(resource['account_id'], resource)) if resource.get('account_id') else None
+        assert not self.accounts or (account_id or self.account_id) in self.accounts, \
+            f"Account is not configured: {account_id or self.account_id}"
+        account_id = (account_id or self.account_id) if self.accounts else None
 
-        action_type = str(jq.first(resource.get('action', '"upsert"'), resource)).lower()
+        action_type = str(run_jq_query(resource.get('action', '"upsert"'), resource)).lower()
         assert action_type in ['upsert', 'delete'], f"Action should be one of 'upsert', 'delete'"
 
-        resource_configs = [resource_config for resource_config in self.resources_config if
-                            resource_config['kind'] == resource['resource_type']]
-        assert resource_configs, f"Resource config not found for kind: {resource['resource_type']}"
+        assert resource.get('resource_type') in self.resources_config_by_kind, \
+            f"Resource config not found for kind: {resource.get('resource_type')}"
 
-        for resource_config in resource_configs:
-            resource_handler = create_resource_handler(resource_config, self.port_client, self.lambda_context, region)
-            resource_handler.handle_single_resource_item(region, identifier, action_type)
+        return resource['resource_type'], account_id, region, identifier, action_type
+
+    def _handle_event_resource(self, kind, account_id, region, identifier, action_type):
+        succeeded = True
+        for resource_config_index in self.resources_config_by_kind[kind]:
+            resource_handler = self._get_event_resource_handler(resource_config_index, account_id, region)
+            with telemetry.scope(kind, region):
+                result = resource_handler.handle_single_resource_item(region, identifier, action_type)
+            # Failures that would fail the same way again, like an entity Port rejects, are not redelivered
+            succeeded = succeeded and not result.get('retry')
+        return succeeded
+
+    def _get_event_resource_handler(self, resource_config_index, account_id, region):
+        # Handlers are reused by all the events of the same config, account and region
+        with self._event_handlers_lock:
+            handler_key = (resource_config_index, account_id, region)
+            if handler_key not in self._event_handlers:
+                resource_config = self.resources_config[resource_config_index]
+                self._event_handlers[handler_key] = create_resource_handler(
+                    self._get_account_resource(resource_config, account_id) if account_id else resource_config,
+                    self._get_port_client(account_id), self.lambda_context, region, fetch_cache=self.fetch_cache)
+            return self._event_handlers[handler_key]
 
     def _upsert_resources(self):
-        for resource_index, resource in enumerate(list(self.resources_config)):
-            resource_handler = create_resource_handler(resource, self.port_client, self.lambda_context, self.region)
-            result = resource_handler.handle()
+        resource_handlers = [
+            create_resource_handler(scan_unit, self._get_port_client(scan_unit['selector']['aws'].get('account_id')),
+                                    self.lambda_context, self.region, self.entities_cache, self.fetch_cache)
+            for scan_unit in self._get_scan_units()]
+        scheduler = ScanScheduler(consts.MAX_CONCURRENT_SCANS, consts.MAX_CONCURRENT_SCANS_PER_REGION,
+                                  consts.MAX_CONCURRENT_SCANS_PER_SERVICE,
+                                  self.config.get('max_concurrent_scans_per_account',
+                                                  consts.MAX_CONCURRENT_SCANS_PER_ACCOUNT))
+        # A scan unit is started only if its first page fits in the time budget, so faster kinds can still use it
+        results = scheduler.run(resource_handlers, should_stop=lambda resource_handler: not (
+            resource_handler.time_budget.can_start_page(0)))
+
+        self.resources_config = []
+        for resource_handler, result in zip(resource_handlers, results):
+            if result is None:  # Wasn't started, keep it as is for the next run
+                self.resources_config.append(resource_handler.resource_config)
+                continue
+            if isinstance(result, Exception):
+                self.aws_entities.update(resource_handler.aws_entities)
+                self._update_skip_delete(resource_handler.account_id, True)
+                self.resources_config.append(self._get_failed_resource_config(resource_handler.resource_config))
+                continue
             self.aws_entities.update(result.get('aws_entities', set()))
-            next_resource_config = result.get('next_resource_config')
-            self.skip_delete = result.get('skip_delete', False) if not self.skip_delete else self.skip_delete
-            self.resources_config[resource_index] = next_resource_config
-            if self.lambda_context.get_remaining_time_in_millis() < consts.REMAINING_TIME_TO_REINVOKE_THRESHOLD:
-                self._handle_close_to_timeout()
-                break
+            self._update_skip_delete(resource_handler.account_id, result.get('skip_delete', False))
+            self.resources_config.append(result.get('next_resource_config'))
+
+        if any(self.resources_config):
+            self._handle_close_to_timeout()
+        elif not self.skip_delete and 'fan_out_shard' not in self.config and \
+                not self.config.get('delete_stale_resources') and self._is_close_to_timeout():
+            # Deleting the stale resources can take a while, so it's left to a new Lambda. The new Lambda deletes them
+            # however long it has, as a function timeout that is shorter than the time it's given would re-invoke it
+            # forever
+            logger.info("Lambda will be timed out soon, a new Lambda will be invoked to delete the stale resources.")
+            self.config['resources'] = []
+            self.config['delete_stale_resources'] = True
+            self.config['skip_delete'] = self.skip_delete
+            self.config['skip_delete_accounts'] = list(self.skip_delete_accounts)
+            self.require_reinvoke = True
+
+    @staticmethod
+    def _get_failed_resource_config(resource_config):
+        # A failed scan unit is retried by the next run from its saved state, up to SCAN_UNIT_MAX_ATTEMPTS times, so
+        # an error that repeats on every attempt doesn't re-invoke the Lambda forever
+        selector_aws = resource_config.setdefault('selector', {}).setdefault('aws', {})
+        selector_aws['failed_attempts'] = selector_aws.get('failed_attempts', 0) + 1
+        if selector_aws['failed_attempts'] >= consts.SCAN_UNIT_MAX_ATTEMPTS:
+            logger.error(f"Giving up on kind: {resource_config.get('kind')}, regions: {selector_aws.get('regions')},"
+                         f" after {selector_aws['failed_attempts']} failed attempts")
+            return None
+        return resource_config
+
+    def _update_skip_delete(self, account_id, skip_delete):
+        # A failure in an account of a multi account sync only keeps the stale entities of that account
+        if skip_delete and account_id:
+            self.skip_delete_accounts.add(account_id)
+        elif skip_delete:
+            self.skip_delete = True
+
+    def _is_bulk_upsert_enabled(self):
+        # The few resources of the SQS events would rarely fill a batch, so waiting for one only adds latency
+        event = self.config.get('event') or {}
+        return self.config.get('bulk_upsert', {}).get('enabled', True) and not event.get('Records')
+
+    def _is_fan_out_coordinator(self):
+        return self.config.get('fan_out', {}).get('enabled') and 'fan_out_shard' not in self.config and any(
+            self.resources_config)
+
+    def _fan_out(self):
+        # Shards the resources by kind and region, and invokes a worker for each shard. Every worker saves its
+        # entities when it's done, and the last one to finish invokes the reducer. Returns False when there's nothing
+        # to scan, like when every kind is unsupported, so this invocation deletes the stale resources without a reducer
+        scan_units = self._get_scan_units()
+        shards = shard_scan_units(scan_units, self.config['fan_out'].get('max_shards', consts.FAN_OUT_MAX_SHARDS))
+        if not shards:
+            logger.info("No scan units to fan out, syncing in this invocation")
+            return False
+        run_dir = os.path.dirname(self.next_config_file_key)
+        logger.info(f"Fan out sync of {len(scan_units)} scan units to {len(shards)} shards, run: {run_dir}")
+
+        base_config = {key: value for key, value in self.config.items() if key != 'event'}
+        base_config['skip_delete'] = self.skip_delete  # Set when a kind was skipped as unsupported
+        base_config['skip_delete_accounts'] = list(self.skip_delete_accounts)
+        save_config(self.bucket_name, get_reduce_config_key(run_dir),
+                    {**base_config, 'resources': [], 'fan_out_reduce': {'run_dir': run_dir,
+                                                                         'shards_count': len(shards)}})
+        for shard_id, shard_resources in enumerate(shards):
+            shard_config_key = get_shard_config_key(run_dir, shard_id)
+            save_config(self.bucket_name, shard_config_key,
+                        {**base_config, 'resources': shard_resources,
+                         'fan_out_shard': {'run_dir': run_dir, 'shard_id': shard_id, 'shards_count': len(shards)}})
+            self._invoke_lambda({'next_config_file_key': shard_config_key})
+        return True
+
+    def _complete_shard(self):
+        fan_out_shard = self.config['fan_out_shard']
+        run_dir = fan_out_shard['run_dir']
+        try:
+            save_shard_result(self.bucket_name, run_dir, fan_out_shard['shard_id'], self.aws_entities,
+                              succeeded=not self.skip_delete, skip_delete_accounts=self.skip_delete_accounts)
+            if count_finished_shards(self.bucket_name, run_dir) < fan_out_shard['shards_count'] or \
+                    not claim_reduce(self.bucket_name, run_dir):
+                return
+        except Exception as e:
+            logger.error(f"Failed to complete shard {fan_out_shard['shard_id']}, run: {run_dir}; {e}")
+            return
+
+        logger.info(f"All the {fan_out_shard['shards_count']} shards have finished, invoking the reducer")
+        self._invoke_lambda({'next_config_file_key': get_reduce_config_key(run_dir)})
+
+    def _reduce_shards(self):
+        run_dir = self.config['fan_out_reduce']['run_dir']
+        shards_aws_entities, succeeded, skip_delete_accounts = load_shard_results(
+            self.bucket_name, run_dir, self.config['fan_out_reduce']['shards_count'])
+        self.aws_entities.update(shards_aws_entities)
+        self.skip_delete_accounts.update(skip_delete_accounts)
+        if succeeded and not self.skip_delete:
+            logger.info("Starting delete process of stale resources from Port")
+            self._delete_stale_resources()
+            logger.info("Done deleting stale resources from Port")
+        else:
+            logger.warning("Skipping delete of stale resources, not all the shards have finished successfully")
+
+        cleanup_run(self.bucket_name, run_dir)
+        self._log_stats()
+        logger.info("Done handling your resources")
+
+    def _is_close_to_timeout(self):
+        return self.lambda_context.get_remaining_time_in_millis() < consts.MIN_REMAINING_TIME_TO_DELETE_STALE_RESOURCES
 
     def _handle_close_to_timeout(self):
         self.config['resources'] = [res_config for res_config in self.resources_config if res_config]
         if self.config['resources']:
             logger.info("Lambda will be timed out soon, a new Lambda will be invoked to continue the sync process.")
-            self.config['aws_entities'] = list(self.aws_entities)
             self.config['skip_delete'] = self.skip_delete
+            self.config['skip_delete_accounts'] = list(self.skip_delete_accounts)
             self.require_reinvoke = True
 
     def _delete_stale_resources(self):
+        # Every account is deleted from on its own, only from the entities that were upserted with its user id
+        account_ids = [account_id for account_id in self.accounts if account_id not in self.skip_delete_accounts] if \
+            self.accounts else [self.account_id]
+        for account_id in self.skip_delete_accounts:
+            logger.warning(f"Skipping delete of stale resources of account: {account_id}, its sync has failed")
+        for account_id in account_ids:
+            self._delete_account_stale_resources(account_id)
+
+    def _delete_account_stale_resources(self, account_id):
+        # Searched and deleted with the account's client, like its entities were upserted. The stale entities of a
+        # page are deleted while the next pages are searched, so only a window of them is kept in memory. The safety
+        # cap is checked on the running counts: stale entities wait while they are over the cap of the entities
+        # searched so far, up to a page of them, for the kept entities of the next pages
+        user_id = self._get_user_id(account_id)
+        port_client = self._get_port_client(account_id)
         query = {"combinator": "and",
                  "rules": [{"property": "$datasource", "operator": "contains", "value": consts.PORT_AWS_EXPORTER_NAME},
-                           {"property": "$datasource", "operator": "contains", "value": self.user_id}]}
-        port_entities = self.port_client.search_entities(query)
+                           {"property": "$datasource", "operator": "contains", "value": user_id}]}
+        max_delete_fraction = self.config.get('stale_entities_max_delete_fraction',
+                                              consts.STALE_ENTITIES_MAX_DELETE_FRACTION)
+        counts = {'deleted': 0, 'failed': 0}
+        counts_lock = threading.Lock()
+        in_flight = threading.BoundedSemaphore(consts.MAX_DELETE_WORKERS * 2)
 
+        def on_delete_done(future):
+            in_flight.release()
+            try:
+                future.result()
+                result = 'deleted'
+            except Exception as e:
+                logger.error(f"Failed to delete stale entity; {e}")
+                result = 'failed'
+            with counts_lock:
+                counts[result] += 1
+
+        waiting_entities = []
+        stale_count = 0
+        kept_count = 0
+        aborted = False
         with ThreadPoolExecutor(max_workers=consts.MAX_DELETE_WORKERS) as executor:
-            executor.map(self.port_client.delete_entity, [entity for entity in port_entities if
-                                                          f"{entity.get('blueprint')};{entity.get('identifier')}" not in self.aws_entities])
+            for port_entities in self._search_entities_pages(port_client, query):
+                for entity in port_entities:
+                    if f"{entity.get('blueprint')};{entity.get('identifier')}" in self.aws_entities:
+                        kept_count += 1
+                    else:
+                        stale_count += 1
+                        waiting_entities.append({'blueprint': entity.get('blueprint'),
+                                                 'identifier': entity.get('identifier')})
+
+                if self._exceeds_delete_safety_cap(stale_count, kept_count + stale_count, max_delete_fraction):
+                    if len(waiting_entities) <= consts.PORT_SEARCH_PAGE_SIZE:
+                        continue
+                    aborted = True
+                    break
+                for entity in waiting_entities:
+                    in_flight.acquire()
+                    executor.submit(port_client.delete_entity, entity).add_done_callback(on_delete_done)
+                waiting_entities = []
+
+        if aborted or waiting_entities:
+            logger.error(f"Aborting delete of stale resources, at least {stale_count} stale entities were found,"
+                         f" which is more than {max_delete_fraction:.0%} of the entities")
+        logger.info(f"Delete stale resources summary of {user_id}, deleted: {counts['deleted']},"
+                    f" failed: {counts['failed']}, skipped: {len(waiting_entities)}, kept: {kept_count}")
+
+    def _search_entities_pages(self, port_client, query):
+        # Only the blueprints that the mappings upsert to are searched. The blueprints with the most entities that
+        # were seen go first, so their kept entities count towards the safety cap before a blueprint that is all stale
+        seen_counts = {blueprint_id: len(digests) for blueprint_id, digests in self.aws_entities.items()}
+        blueprint_ids = [blueprint_id for blueprint_id in port_client.get_blueprints()
+                         if blueprint_id in self.config['mappings_blueprints']]
+        for blueprint_id in sorted(blueprint_ids, key=lambda blueprint_id: -seen_counts.get(blueprint_id, 0)):
+            yield from port_client.search_blueprint_entities(blueprint_id, query)
+
+    @staticmethod
+    def _exceeds_delete_safety_cap(stale_count, total_count, max_delete_fraction):
+        return stale_count > consts.STALE_ENTITIES_DELETE_SAFETY_MIN_COUNT and \
+            stale_count > max_delete_fraction * total_count
 
     def _reinvoke_lambda(self):
         self._save_config_state()
         payload = {'next_config_file_key': self.next_config_file_key}
+        return self._invoke_lambda(payload)
+
+        # self.__init__(self.config, self.lambda_context)  # return self.handle()
 
-        aws_lambda_client = boto3.client('lambda')
+    def _invoke_lambda(self, payload):
+        if self.event and self.event.get('profile'):  # Re-invocations and shards of a profiled run are profiled too
+            payload = {**payload, 'profile': self.event['profile']}
+        aws_lambda_client = get_client('lambda')
         return aws_lambda_client.invoke(FunctionName=self.lambda_context.function_name, InvocationType='Event',
             Payload=json.dumps(payload), )
 
-        # self.__init__(self.config, self.lambda_context)  # return self.handle()
-
     def _save_config_state(self):
-        aws_s3_client = boto3.client('s3')
+        checkpoint_file_key = os.path.join(os.path.dirname(self.next_config_file_key),
+                                           consts.ENTITIES_CHECKPOINT_FILE_NAME)
+        try:
+            save_entities_checkpoint(self.bucket_name, checkpoint_file_key, self.aws_entities)
+            self.config['aws_entities_checkpoint_file_key'] = checkpoint_file_key
+        except Exception as e:
+            logger.warning(
+                f"Failed to save entities checkpoint, bucket: {self.bucket_name}, key: {checkpoint_file_key}; {e}")
+            self.skip_delete = True
+            self.config['skip_delete'] = True
+
+        aws_s3_client = get_client('s3')
         try:
             aws_s3_client.put_object(Body=json.dumps(self.config), Bucket=self.bucket_name,
                                      Key=self.next_config_file_key)
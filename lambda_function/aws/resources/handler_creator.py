@@ -7,6 +7,7 @@ from aws.resources.cloudformation_handler import CloudFormationHandler
 SPECIAL_AWS_HANDLERS: Dict[str, Type[BaseHandler]] = {"AWS::CloudFormation::Stack": CloudFormationHandler}
 
 
-def create_resource_handler(resource_config, port_client, lambda_context, default_region):
+def create_resource_handler(resource_config, port_client, lambda_context, default_region, entities_cache=None,
+                            fetch_cache=None):
     handler = SPECIAL_AWS_HANDLERS.get(resource_config['kind'], CloudControlHandler)
-    return handler(resource_config, port_client, lambda_context, default_region)
+    return handler(resource_config, port_client, lambda_context, default_region, entities_cache, fetch_cache)
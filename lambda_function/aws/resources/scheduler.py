@@ -0,0 +1,76 @@
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger(__name__)
+
+
+def get_service_name(kind):
+    # AWS::EC2::Instance -> ec2
+    split_kind = kind.split('::')
+    return split_kind[1].lower() if len(split_kind) > 1 else kind.lower()
+
+
+class ScanScheduler:
+    def __init__(self, max_workers, max_workers_per_region, max_workers_per_service, max_workers_per_account):
+        self.max_workers = max_workers
+        self.max_workers_per_region = max_workers_per_region
+        self.max_workers_per_service = max_workers_per_service
+        self.max_workers_per_account = max_workers_per_account
+
+    def run(self, resource_handlers, should_stop):
+        # Returns the handle result of every resource handler by order, None for the handlers that were not started
+        # because should_stop(resource_handler) returned True on their turn, and the exception of the handlers that
+        # failed, which doesn't stop the others. The first handler is always started, so every run makes progress
+        results = [None] * len(resource_handlers)
+        pending = list(range(len(resource_handlers)))
+        running = {}
+        running_per_region = Counter()
+        running_per_service = Counter()
+        running_per_account = Counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                for index in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    account, region, service = self._get_scan_unit_key(resource_handlers[index])
+                    if running_per_region[region] >= self.max_workers_per_region or \
+                            running_per_service[service] >= self.max_workers_per_service or \
+                            running_per_account[account] >= self.max_workers_per_account or \
+                            (len(pending) < len(resource_handlers) and should_stop(resource_handlers[index])):
+                        continue
+                    pending.remove(index)
+                    running_per_region[region] += 1
+                    running_per_service[service] += 1
+                    running_per_account[account] += 1
+                    running[executor.submit(resource_handlers[index].handle)] = index, account, region, service
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for completed_future in done:
+                    # The key is kept aside, as handling a resource cleans up its regions
+                    index, account, region, service = running.pop(completed_future)
+                    running_per_region[region] -= 1
+                    running_per_service[service] -= 1
+                    running_per_account[account] -= 1
+                    try:
+                        results[index] = completed_future.result()
+                    except Exception as e:
+                        logger.error(f"Failed to handle kind: {resource_handlers[index].kind}, account: {account},"
+                                     f" region: {region[1]}; {e}")
+                        results[index] = e
+
+        if pending:
+            logger.info(f"Lambda will be timed out soon, {len(pending)} resource scans were not started")
+
+        return results
+
+    @staticmethod
+    def _get_scan_unit_key(resource_handler):
+        # AWS throttles every account on its own, so the region and service limits are per account as well
+        account = resource_handler.account_id
+        region = resource_handler.regions[0] if resource_handler.regions else None
+        return account, (account, region), (account, get_service_name(resource_handler.kind))
@@ -0,0 +1,68 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import consts
+from aws.clients import get_client
+
+logger = logging.getLogger(__name__)
+
+# Catalog of what CloudControl supports for every kind in a region, written by scripts/list_types.py:
+#   {"version": 2, "region": "us-east-1", "created_at": "...", "types": {"AWS::S3::Bucket": {"list": true,
+#    "required_resource_model": []}, ...}}
+# "list" is false only when CloudControl can't list the kind, and null when the probe failed for another reason
+# Kept at module level by region, so warm invocations don't read it again
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog_file_key(catalog_dir_key, region):
+    return os.path.join(catalog_dir_key, f"{region}.json")
+
+
+def create_catalog(region, types, created_at):
+    return {'version': consts.CAPABILITY_CATALOG_VERSION, 'region': region, 'created_at': created_at,
+            'types': types}
+
+
+def load_catalog(bucket_name, catalog_dir_key, region):
+    # Returns the capabilities of the kinds in the region by kind, None if there's no catalog of the current version
+    catalog_file_key = get_catalog_file_key(catalog_dir_key, region)
+    with _catalogs_lock:
+        cached_catalog = _catalogs.get((bucket_name, catalog_file_key))
+    if cached_catalog and time.monotonic() < cached_catalog['expires_at']:
+        return cached_catalog['types']
+
+    types = None
+    aws_s3_client = get_client('s3')
+    try:
+        catalog = json.loads(aws_s3_client.get_object(Bucket=bucket_name, Key=catalog_file_key)['Body'].read())
+        if catalog.get('version') == consts.CAPABILITY_CATALOG_VERSION:
+            types = catalog.get('types', {})
+        else:
+            logger.warning(f"Ignoring capability catalog of version: {catalog.get('version')}, key: {catalog_file_key}")
+    except aws_s3_client.exceptions.NoSuchKey:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to load capability catalog, bucket: {bucket_name}, key: {catalog_file_key}; {e}")
+
+    # A missing catalog is cached as well, so it's not looked up on every invocation
+    with _catalogs_lock:
+        _catalogs[(bucket_name, catalog_file_key)] = {
+            'types': types, 'expires_at': time.monotonic() + consts.CAPABILITY_CATALOG_CACHE_TTL}
+    return types
+
+
+def get_unsupported_reason(kind_capabilities, resource_model):
+    # Returns why the kind can't be listed with the resource model, None if it can or if the catalog doesn't know
+    if kind_capabilities is None:
+        return None
+    if kind_capabilities.get('list') is False:
+        return f"listing is not supported ({kind_capabilities.get('error', 'unknown')})"
+    missing_properties = [property_name for property_name in kind_capabilities.get('required_resource_model', [])
+                          if property_name not in json.loads(resource_model or '{}')]
+    if missing_properties:
+        return f"listing requires the resource model properties: {', '.join(missing_properties)}"
+    return None
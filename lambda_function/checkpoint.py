@@ -0,0 +1,78 @@
+import base64
+import gzip
+import json
+import logging
+import sys
+import tempfile
+from array import array
+
+import consts
+from aws.clients import get_client
+from port.entity_set import EntitySet
+
+logger = logging.getLogger(__name__)
+
+# Version 1 is the legacy format, a list of "blueprint;identifier" strings under 'aws_entities' in the config state.
+# Version 2 is a gzip compressed JSON lines object: a header line, followed by lines of identifiers grouped by blueprint.
+# Version 3 is like version 2, with the base64 of the sorted little endian 64 bits digests of the identifiers, as kept
+# by EntitySet, instead of the identifiers
+ENTITIES_CHECKPOINT_VERSION = 3
+SUPPORTED_ENTITIES_CHECKPOINT_VERSIONS = (2, 3)
+
+
+def save_entities_checkpoint(bucket_name, file_key, aws_entities):
+    if not isinstance(aws_entities, EntitySet):
+        aws_entities = EntitySet(aws_entities)
+
+    with tempfile.TemporaryFile() as checkpoint_file:
+        with gzip.GzipFile(fileobj=checkpoint_file, mode='wb') as gzip_file:
+            gzip_file.write(_to_json_line({'version': ENTITIES_CHECKPOINT_VERSION, 'count': len(aws_entities)}))
+            for blueprint_id, digests in aws_entities.items():
+                for chunk_start in range(0, len(digests), consts.ENTITIES_CHECKPOINT_CHUNK_SIZE):
+                    gzip_file.write(_to_json_line({'blueprint': blueprint_id, 'digests': _encode_digests(
+                        digests[chunk_start:chunk_start + consts.ENTITIES_CHECKPOINT_CHUNK_SIZE])}))
+        checkpoint_file.seek(0)
+        get_client('s3').upload_fileobj(checkpoint_file, bucket_name, file_key)
+
+
+def load_entities_checkpoint(bucket_name, file_key):
+    aws_s3_client = get_client('s3')
+    aws_entities = EntitySet()
+    response = aws_s3_client.get_object(Bucket=bucket_name, Key=file_key)
+    with gzip.GzipFile(fileobj=response['Body'], mode='rb') as gzip_file:
+        lines = iter(gzip_file)
+        header = json.loads(next(lines))
+        assert header.get('version') in SUPPORTED_ENTITIES_CHECKPOINT_VERSIONS, \
+            f"Unsupported entities checkpoint version: {header.get('version')}"
+        for line in lines:
+            chunk = json.loads(line)
+            if 'digests' in chunk:
+                aws_entities.add_digests(chunk['blueprint'], _decode_digests(chunk['digests']))
+            else:  # Version 2, written before an upgrade
+                aws_entities.update(f"{chunk['blueprint']};{entity_id}" for entity_id in chunk['identifiers'])
+
+    # Clean checkpoint from s3 after reading it
+    try:
+        aws_s3_client.delete_object(Bucket=bucket_name, Key=file_key)
+    except Exception as e:
+        logger.warning(f"Failed to clean entities checkpoint, bucket: {bucket_name}, key: {file_key}; {e}")
+
+    return aws_entities
+
+
+def _encode_digests(digests):
+    if sys.byteorder != 'little':
+        digests = array('Q', digests)
+        digests.byteswap()
+    return base64.b64encode(digests.tobytes()).decode()
+
+
+def _decode_digests(encoded_digests):
+    digests = array('Q', base64.b64decode(encoded_digests))
+    if sys.byteorder != 'little':
+        digests.byteswap()
+    return digests
+
+
+def _to_json_line(obj):
+    return (json.dumps(obj, separators=(',', ':')) + '\n').encode()
@@ -0,0 +1,105 @@
+import itertools
+import logging
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import consts
+import telemetry
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+                          'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException',
+                          'SlowDown', 'PriorRequestNotComplete'}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+class AdaptiveLimiter:
+    # Additive increase / multiplicative decrease: the limit grows by one after a full window of successful calls,
+    # and is cut by a factor on every throttled call
+    def __init__(self, name, initial_limit, min_limit, max_limit):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        self.calls = 0
+        self.throttles = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            self.calls += 1
+            if throttled:
+                self.throttles += 1
+                self._successes = 0
+                self.limit = max(self.min_limit, self.limit * consts.ADAPTIVE_CONCURRENCY_DECREASE_FACTOR)
+            else:
+                self._successes += 1
+                if self._successes >= int(self.limit):
+                    self._successes = 0
+                    self.limit = min(self.max_limit, self.limit + 1)
+            self._condition.notify_all()
+
+
+def get_limiter(name, initial_limit, min_limit, max_limit):
+    # Kept at module level, so the learned limits are reused across warm invocations
+    with _limiters_lock:
+        if name not in _limiters:
+            _limiters[name] = AdaptiveLimiter(name, initial_limit, min_limit, max_limit)
+        return _limiters[name]
+
+
+def get_aws_limiter(service_name, region, account_id=None):
+    account_prefix = f"{account_id}:" if account_id else ''
+    return get_limiter(f"aws:{account_prefix}{service_name}:{region}", **consts.AWS_CONCURRENCY_LIMITS)
+
+
+def get_port_limiter(endpoint):
+    return get_limiter(f"port:{endpoint}", **consts.PORT_CONCURRENCY_LIMITS)
+
+
+def is_throttling_error(error):
+    return isinstance(error, ClientError) and error.response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def call_aws(limiter, func, **kwargs):
+    for attempt in itertools.count():
+        limiter.acquire()
+        throttled = False
+        try:
+            return func(**kwargs)
+        except Exception as e:
+            throttled = is_throttling_error(e)
+            if throttled:
+                telemetry.record_throttle()
+            if not throttled or attempt >= consts.AWS_THROTTLING_MAX_RETRIES:
+                raise
+        finally:
+            limiter.release(throttled)
+
+        delay = random.uniform(0, min(consts.AWS_THROTTLING_MAX_DELAY, consts.AWS_THROTTLING_BASE_DELAY * 2 ** attempt))
+        logger.warning(f"Throttled by AWS, limiter: {limiter.name}, limit: {int(limiter.limit)},"
+                       f" retrying in {delay:.2f}s")
+        time.sleep(delay)
+
+
+def log_limiters():
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    for limiter in limiters:
+        logger.info(f"Concurrency limiter: {limiter.name}, limit: {int(limiter.limit)}, calls: {limiter.calls},"
+                    f" throttles: {limiter.throttles}")
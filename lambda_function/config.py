@@ -1,13 +1,21 @@
 import json
 import logging
 import os
+import threading
+import time
 
-import boto3
+from botocore.exceptions import ClientError
+
+import consts
+from aws.clients import get_client
 
 logger = logging.getLogger(__name__)
 
-aws_secretsmanager_client = boto3.client('secretsmanager')
-aws_s3_client = boto3.client('s3')
+# The config file and the Port credentials are kept at module level, so warm invocations, like the frequent ones of
+# the SQS events, don't fetch them again
+_config_file_cache = {}
+_port_credentials_cache = {}
+_cache_lock = threading.Lock()
 
 
 def get_config(event, lambda_context):
@@ -15,7 +23,13 @@ def get_config(event, lambda_context):
     resources_config = _get_resources_config(event, lambda_context)
     logger.info("Load port credentials from secrets manager")
     port_creds = _get_port_credentials(event)
-    return {**{'event': event}, **resources_config, **port_creds}
+    return {**resources_config, **port_creds, **{'event': event}}
+
+
+def clear_port_credentials_cache():
+    # Called when Port rejects the credentials, as the secret may have been rotated
+    with _cache_lock:
+        _port_credentials_cache.clear()
 
 
 def _get_resources_config(event, lambda_context):
@@ -26,31 +40,74 @@ def _get_resources_config(event, lambda_context):
     # Not supposed to happen. Just make sure to not accept the original config as next config, so it won't get deleted
     assert next_config_file_key != original_config_file_key, "next_config_file_key must not equal CONFIG_JSON_FILE_KEY"
 
-    config_json_file_key = next_config_file_key or original_config_file_key
-    config_from_s3 = json.loads(aws_s3_client.get_object(Bucket=bucket_name, Key=config_json_file_key)['Body'].read())
+    if next_config_file_key:  # The state of a re-invoked lambda is read only once, so it's not cached
+        config_file_body = get_client('s3').get_object(Bucket=bucket_name, Key=next_config_file_key)['Body'].read()
+    else:
+        config_file_body = _get_config_file_body(bucket_name, original_config_file_key)
+    # Parsed on every invocation, as the handlers change the config they are given
+    config_from_s3 = json.loads(config_file_body)
 
     assert 'resources' in config_from_s3, "resources key is missing from config file json"
 
     if next_config_file_key:  # In case it's a re-invoked lambda
         # Clean config state from s3 after reading it
         try:
-            aws_s3_client.delete_object(Bucket=bucket_name, Key=next_config_file_key)
+            get_client('s3').delete_object(Bucket=bucket_name, Key=next_config_file_key)
         except Exception as e:
             logger.warning(f"Failed to clean config state, bucket: {bucket_name}, key: {next_config_file_key}; {e}")
     else:
         next_config_file_key = os.path.join(os.path.dirname(original_config_file_key), lambda_context.aws_request_id,
                                             "config.json")
 
-    s3_config = {'bucket_name': bucket_name, 'next_config_file_key': next_config_file_key}
+    s3_config = {'bucket_name': bucket_name, 'next_config_file_key': next_config_file_key,
+                 'entities_cache_file_key': os.path.join(os.path.dirname(original_config_file_key),
+                                                         consts.ENTITIES_CACHE_FILE_NAME),
+                 'capability_catalog_dir_key': os.path.join(os.path.dirname(original_config_file_key),
+                                                            consts.CAPABILITY_CATALOG_DIR_NAME)}
 
     return {**config_from_s3, **s3_config}
 
 
+def _get_config_file_body(bucket_name, config_file_key):
+    cache_key = (bucket_name, config_file_key)
+    with _cache_lock:
+        cached_config_file = _config_file_cache.get(cache_key)
+    if cached_config_file and time.monotonic() < cached_config_file['expires_at']:
+        return cached_config_file['body']
+
+    get_object_kwargs = {'IfNoneMatch': cached_config_file['etag']} if cached_config_file else {}
+    try:
+        config_file = get_client('s3').get_object(Bucket=bucket_name, Key=config_file_key, **get_object_kwargs)
+        config_file_body = config_file['Body'].read()
+        etag = config_file.get('ETag')
+    except ClientError as e:
+        if e.response.get('ResponseMetadata', {}).get('HTTPStatusCode') != 304:
+            raise
+        logger.info("Config file was not modified, using the cached config")
+        config_file_body = cached_config_file['body']
+        etag = cached_config_file['etag']
+
+    if etag:
+        with _cache_lock:
+            _config_file_cache[cache_key] = {'body': config_file_body, 'etag': etag,
+                                             'expires_at': time.monotonic() + consts.CONFIG_CACHE_TTL}
+    return config_file_body
+
+
 def _get_port_credentials(event):
     if event.get('port_client_id'):
         return {**{key: event.get(key) for key in ['port_client_id', 'port_client_secret', 'port_api_url']},
                 **{'keep_cred': True}}
 
     secret_arn = os.getenv('PORT_CREDS_SECRET_ARN')
-    port_creds = json.loads(aws_secretsmanager_client.get_secret_value(SecretId=secret_arn).get('SecretString', '{}'))
+    with _cache_lock:
+        cached_port_creds = _port_credentials_cache.get(secret_arn)
+    if cached_port_creds and time.monotonic() < cached_port_creds['expires_at']:
+        port_creds = cached_port_creds['port_creds']
+    else:
+        port_creds = json.loads(
+            get_client('secretsmanager').get_secret_value(SecretId=secret_arn).get('SecretString', '{}'))
+        with _cache_lock:
+            _port_credentials_cache[secret_arn] = {'port_creds': port_creds,
+                                                   'expires_at': time.monotonic() + consts.PORT_CREDS_CACHE_TTL}
     return {'port_client_id': port_creds['id'], 'port_client_secret': port_creds['clientSecret']}
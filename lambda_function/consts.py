@@ -1,5 +1,56 @@
 PORT_API_URL = 'https://api.getport.io/v1'
 PORT_AWS_EXPORTER_NAME = "port-aws-exporter"
-MAX_UPSERT_WORKERS = 2
-MAX_DELETE_WORKERS = 5
-REMAINING_TIME_TO_REINVOKE_THRESHOLD = 1000 * 60 * 5  # 5 minutes
+# Upper bounds for the workers, the actual concurrency is adapted by the AWS and Port concurrency limiters
+MAX_UPSERT_WORKERS = 16
+MAX_DELETE_WORKERS = 16
+REMAINING_TIME_TO_REINVOKE_THRESHOLD = 1000 * 60  # 1 minute, kept for saving the state and re-invoking
+JQ_PROGRAMS_CACHE_SIZE = 1024
+PORT_REQUEST_TIMEOUT = 30  # Seconds
+PORT_MAX_RETRIES = 5
+PORT_RETRY_BASE_DELAY = 0.5  # Seconds
+PORT_RETRY_MAX_DELAY = 30  # Seconds
+PORT_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+PORT_REJECTED_STATUS_CODES = (400, 404, 413, 422)  # Entities that Port rejects the same way on every attempt
+ENTITIES_CACHE_FILE_NAME = "entities_cache.json"
+ENTITIES_CACHE_FULL_RESYNC_INTERVAL_HOURS = 24
+MAX_CONCURRENT_SCANS = 8
+MAX_CONCURRENT_SCANS_PER_REGION = 4
+MAX_CONCURRENT_SCANS_PER_SERVICE = 2
+MAX_CONCURRENT_SCANS_PER_ACCOUNT = 4
+SCAN_UNIT_MAX_ATTEMPTS = 3  # Runs that a scan unit fails in, before it's given up until the next sync
+AWS_CONCURRENCY_LIMITS = {'initial_limit': 2, 'min_limit': 1, 'max_limit': MAX_UPSERT_WORKERS}
+PORT_CONCURRENCY_LIMITS = {'initial_limit': 5, 'min_limit': 1, 'max_limit': 32}
+ADAPTIVE_CONCURRENCY_DECREASE_FACTOR = 0.5
+AWS_THROTTLING_MAX_RETRIES = 5
+AWS_THROTTLING_BASE_DELAY = 1  # Seconds
+AWS_THROTTLING_MAX_DELAY = 20  # Seconds
+PREFETCH_PAGES = 2
+MAX_IN_FLIGHT_ITEMS = MAX_UPSERT_WORKERS * 2
+ENTITIES_CHECKPOINT_FILE_NAME = "aws_entities.jsonl.gz"
+ENTITIES_CHECKPOINT_CHUNK_SIZE = 10000
+PORT_SEARCH_PAGE_SIZE = 1000
+STALE_ENTITIES_MAX_DELETE_FRACTION = 0.5
+STALE_ENTITIES_DELETE_SAFETY_MIN_COUNT = 50
+FETCH_CACHE_MAX_SIZE = 200 * 1024 * 1024  # Bytes
+FAN_OUT_MAX_SHARDS = 64
+DEFAULT_PAGE_LATENCY = 10  # Seconds, until a page of the kind was listed
+DEFAULT_ITEM_LATENCY = 5  # Seconds, until an item of the kind was handled
+LATENCY_EWMA_WEIGHT = 0.125
+LATENCY_DEVIATION_EWMA_WEIGHT = 0.25
+MIN_REMAINING_TIME_TO_DELETE_STALE_RESOURCES = 1000 * 60 * 5  # 5 minutes
+METRICS_NAMESPACE = "PortAwsExporter"
+CONFIG_CACHE_TTL = 60  # Seconds, until the config file is checked again for changes
+PORT_CREDS_CACHE_TTL = 60 * 15  # 15 minutes
+PORT_TOKEN_DEFAULT_TTL = 60 * 60  # Seconds, when the token response has no expiry
+PORT_TOKEN_EXPIRY_MARGIN = 60 * 5  # 5 minutes, before the token expires
+PORT_BULK_UPSERT_MAX_ENTITIES = 20
+PORT_BULK_UPSERT_MAX_SIZE = 512 * 1024  # Bytes
+PORT_BULK_UPSERT_LINGER = 0.05  # Seconds, until a batch that isn't full is sent
+CAPABILITY_CATALOG_VERSION = 2  # 1 marked the kinds that failed to probe for any reason as unsupported
+CAPABILITY_CATALOG_DIR_NAME = "capability_catalog"
+CAPABILITY_CATALOG_CACHE_TTL = 60 * 60  # 1 hour
+ENTITY_SET_MAX_PENDING = 4096  # Identifiers, that are added before they are sorted into a run of digests
+PROFILES_DIR_NAME = "profiles"
+PROFILE_SAMPLE_INTERVAL = 0.01  # Seconds, between samples of the stacks of all the threads
+PROFILE_TRACEMALLOC_FRAMES = 1  # Frames of an allocation site, every frame adds to the overhead
+PROFILE_TOP_ALLOCATIONS = 30
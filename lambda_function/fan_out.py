@@ -0,0 +1,107 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from botocore.exceptions import ClientError
+
+from aws.clients import get_client
+from checkpoint import save_entities_checkpoint, load_entities_checkpoint
+from port.entity_set import EntitySet
+
+logger = logging.getLogger(__name__)
+
+# Layout of a fan out sync under its run directory:
+#   shards/<shard id>/config.json - config state of a shard worker, also used by its re-invocations
+#   partials/<shard id>.json - status of a finished shard, next to partials/<shard id>.jsonl.gz with its entities
+#   reduce/config.json - config of the reducer, that deletes the stale entities once every shard has finished
+#   reduce.lock - created by the shard that invokes the reducer, so it's invoked only once
+
+
+def get_shard_config_key(run_dir, shard_id):
+    return os.path.join(run_dir, 'shards', str(shard_id), 'config.json')
+
+
+def get_reduce_config_key(run_dir):
+    return os.path.join(run_dir, 'reduce', 'config.json')
+
+
+def shard_scan_units(scan_units, max_shards):
+    # Scan units of the same kind, account and region are kept together, so they share fetches and a worker's time
+    # budget. Groups are spread round robin when there are more of them than shards
+    groups = OrderedDict()
+    for scan_unit in scan_units:
+        selector_aws = scan_unit['selector']['aws']
+        groups.setdefault((scan_unit['kind'], selector_aws.get('account_id'), selector_aws['regions'][0]),
+                          []).append(scan_unit)
+    shards = [[] for _ in range(min(len(groups), max_shards))]
+    for group_index, group in enumerate(groups.values()):
+        shards[group_index % len(shards)].extend(group)
+    return shards
+
+
+def save_config(bucket_name, file_key, config):
+    get_client('s3').put_object(Body=json.dumps(config), Bucket=bucket_name, Key=file_key)
+
+
+def save_shard_result(bucket_name, run_dir, shard_id, aws_entities, succeeded, skip_delete_accounts=()):
+    entities_file_key = os.path.join(run_dir, 'partials', f"{shard_id}.jsonl.gz")
+    save_entities_checkpoint(bucket_name, entities_file_key, aws_entities)
+    # The status is written last, so a shard is counted as finished only once its entities are saved
+    save_config(bucket_name, os.path.join(run_dir, 'partials', f"{shard_id}.json"),
+                {'shard_id': shard_id, 'succeeded': succeeded, 'entities_file_key': entities_file_key,
+                 'skip_delete_accounts': list(skip_delete_accounts)})
+
+
+def count_finished_shards(bucket_name, run_dir):
+    paginator = get_client('s3').get_paginator('list_objects_v2')
+    return sum(1 for page in paginator.paginate(Bucket=bucket_name, Prefix=os.path.join(run_dir, 'partials', ''))
+               for s3_object in page.get('Contents', []) if s3_object['Key'].endswith('.json'))
+
+
+def claim_reduce(bucket_name, run_dir):
+    # Several shards can see that all the shards have finished, only the one that creates the lock invokes the reducer
+    try:
+        get_client('s3').put_object(Body=b'', Bucket=bucket_name, Key=os.path.join(run_dir, 'reduce.lock'),
+                                    IfNoneMatch='*')
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            return False
+        raise
+
+
+def load_shard_results(bucket_name, run_dir, shards_count):
+    # Returns the entities of all the shards, whether every shard has finished successfully, and the accounts that
+    # failed in any of the shards
+    aws_s3_client = get_client('s3')
+    aws_entities = EntitySet()
+    succeeded = True
+    skip_delete_accounts = set()
+    for shard_id in range(shards_count):
+        status_file_key = os.path.join(run_dir, 'partials', f"{shard_id}.json")
+        try:
+            status = json.loads(aws_s3_client.get_object(Bucket=bucket_name, Key=status_file_key)['Body'].read())
+            aws_entities.update(load_entities_checkpoint(bucket_name, status['entities_file_key']))
+        except Exception as e:
+            logger.warning(f"Failed to load shard result, bucket: {bucket_name}, key: {status_file_key}; {e}")
+            succeeded = False
+            continue
+        skip_delete_accounts.update(status.get('skip_delete_accounts', []))
+        if not status.get('succeeded'):
+            logger.warning(f"Shard {shard_id} didn't finish successfully")
+            succeeded = False
+    return aws_entities, succeeded, skip_delete_accounts
+
+
+def cleanup_run(bucket_name, run_dir):
+    aws_s3_client = get_client('s3')
+    paginator = aws_s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=os.path.join(run_dir, '')):
+        s3_objects = [{'Key': s3_object['Key']} for s3_object in page.get('Contents', [])]
+        if not s3_objects:
+            continue
+        try:
+            aws_s3_client.delete_objects(Bucket=bucket_name, Delete={'Objects': s3_objects, 'Quiet': True})
+        except Exception as e:
+            logger.warning(f"Failed to clean fan out run, bucket: {bucket_name}, prefix: {run_dir}; {e}")
@@ -1,40 +1,286 @@
+import email.utils
 import logging
+import random
+import threading
+import time
+from collections import defaultdict
 
 import requests
+from requests.adapters import HTTPAdapter
+
+import consts
+import telemetry
+from concurrency import get_port_limiter
+from port.upsert_batcher import UpsertBatcher
 
 logger = logging.getLogger(__name__)
 
+_session = None
+_session_lock = threading.Lock()
+# Access tokens are reused by warm invocations until they are close to expire
+_access_tokens = {}
+_access_tokens_lock = threading.Lock()
+
+
+def get_session():
+    # A single session is shared by all the clients and workers, so connections are kept alive across
+    # requests and warm invocations
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = consts.PORT_CONCURRENCY_LIMITS['max_limit']
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            _session = requests.Session()
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _parse_retry_after(retry_after):
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable_port_error(error):
+    # Errors without a status are connection errors and timeouts
+    if isinstance(error, requests.exceptions.HTTPError):
+        status_code = error.response.status_code if error.response is not None else None
+    else:
+        status_code = getattr(error, 'status_code', None)
+    return status_code not in consts.PORT_REJECTED_STATUS_CODES
+
+
+class PortEntityError(Exception):
+    # Error of a single entity in a bulk request
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
 
 class PortClient:
-    def __init__(self, client_id, client_secret, user_agent, api_url):
+    def __init__(self, client_id, client_secret, user_agent, api_url, bulk_upsert=False):
         self.api_url = api_url
-        self.access_token = self.get_token(client_id, client_secret)
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = get_session()
+        self.stats = defaultdict(lambda: {'calls': 0, 'retries': 0, 'throttles': 0, 'errors': 0, 'latency_ms': 0.0,
+                                          'max_latency_ms': 0.0})
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self.upsert_batcher = UpsertBatcher(self._upsert_batch, consts.PORT_BULK_UPSERT_MAX_ENTITIES,
+                                            consts.PORT_BULK_UPSERT_MAX_SIZE,
+                                            consts.PORT_BULK_UPSERT_LINGER) if bulk_upsert else None
+        self.bulk_upsert_supported = True
+        self.access_token = self.get_token()
         self.headers = {'Authorization': f'Bearer {self.access_token}', 'User-Agent': user_agent}
 
-    def get_token(self, client_id, client_secret):
-        credentials = {'clientId': client_id, 'clientSecret': client_secret}
-        token_response = requests.post(f'{self.api_url}/auth/access_token', json=credentials)
-        token_response.raise_for_status()
-        return token_response.json()['accessToken']
+    def get_token(self, expired_token=None):
+        # A token that Port has rejected is not reused, even when it is cached
+        token_key = (self.api_url, self.client_id, self.client_secret)
+        with _access_tokens_lock:
+            cached_token = _access_tokens.get(token_key)
+            if cached_token and cached_token['access_token'] != expired_token and \
+                    time.monotonic() < cached_token['expires_at']:
+                return cached_token['access_token']
+            _access_tokens.pop(token_key, None)
+
+        credentials = {'clientId': self.client_id, 'clientSecret': self.client_secret}
+        token_response = self._request('token', 'POST', f'{self.api_url}/auth/access_token', json=credentials,
+                                       refresh_token=False).json()
+        expires_in = token_response.get('expiresIn', consts.PORT_TOKEN_DEFAULT_TTL)
+        with _access_tokens_lock:
+            _access_tokens[token_key] = {'access_token': token_response['accessToken'],
+                                         'expires_at': time.monotonic() + expires_in - consts.PORT_TOKEN_EXPIRY_MARGIN}
+        return token_response['accessToken']
 
     def upsert_entity(self, entity):
         blueprint_id = entity.pop('blueprint')
-        logger.info(f"Upsert entity: {entity.get('identifier')} of blueprint: {blueprint_id}")
-        requests.post(f'{self.api_url}/blueprints/{blueprint_id}/entities', json=entity,
-                      headers=self.headers,
-                      params={'upsert': 'true', 'merge': 'true'}).raise_for_status()
+        if telemetry.should_log_entity():
+            logger.info(f"Upsert entity: {entity.get('identifier')} of blueprint: {blueprint_id}")
+        with telemetry.timer('upsert'):
+            self._request('upsert', 'POST', f'{self.api_url}/blueprints/{blueprint_id}/entities', json=entity,
+                          params={'upsert': 'true', 'merge': 'true'})
+
+    def upsert_entities(self, entities):
+        # Returns the error of every entity by order, None for the entities that were upserted. With bulk upsert, the
+        # entities are sent in batches together with the entities that the other workers upsert at the same time
+        if not self.upsert_batcher:
+            return [self._try_upsert_entity(entity) for entity in entities]
+        futures = []
+        for entity in entities:
+            blueprint_id = entity.pop('blueprint')
+            futures.append((blueprint_id, self.upsert_batcher.submit(blueprint_id, entity)))
+        return [self.upsert_batcher.wait(blueprint_id, future) for blueprint_id, future in futures]
 
     def delete_entity(self, entity):
         blueprint_id = entity.pop('blueprint')
         entity_id = entity.pop('identifier')
-        logger.info(f"Delete entity: {entity_id} of blueprint: {blueprint_id}")
-        requests.delete(f'{self.api_url}/blueprints/{blueprint_id}/entities/{entity_id}',
-                        headers=self.headers,
-                        params={'delete_dependents': 'true'}).raise_for_status()
-
-    def search_entities(self, query):
-        search_req = requests.post(f"{self.api_url}/entities/search", json=query, headers=self.headers,
-                                   params={'exclude_calculated_properties': 'true',
-                                           'include': ['blueprint', 'identifier']})
-        search_req.raise_for_status()
-        return search_req.json()['entities']
+        if telemetry.should_log_entity():
+            logger.info(f"Delete entity: {entity_id} of blueprint: {blueprint_id}")
+        with telemetry.timer('delete'):
+            try:
+                self._request('delete', 'DELETE', f'{self.api_url}/blueprints/{blueprint_id}/entities/{entity_id}',
+                              params={'delete_dependents': 'true'})
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                # Deletes are repeated by redelivered events and by retries, an entity that is gone is deleted
+                logger.info(f"Entity: {entity_id} of blueprint: {blueprint_id} was already deleted")
+
+    def get_blueprints(self):
+        blueprints_req = self._request('blueprints', 'GET', f"{self.api_url}/blueprints")
+        return [blueprint['identifier'] for blueprint in blueprints_req.json()['blueprints']]
+
+    def search_blueprint_entities(self, blueprint_id, query):
+        # Yields the matching entities of the blueprint page by page
+        search_body = {'query': query, 'include': ['blueprint', 'identifier'], 'limit': consts.PORT_SEARCH_PAGE_SIZE}
+        while True:
+            with telemetry.timer('search'):
+                search_req = self._request('search', 'POST',
+                                           f"{self.api_url}/blueprints/{blueprint_id}/entities/search",
+                                           json=search_body, params={'exclude_calculated_properties': 'true'})
+            search_response = search_req.json()
+            yield search_response['entities']
+            if not search_response.get('next'):
+                return
+            search_body['from'] = search_response['next']
+
+    def get_stats(self):
+        with self._lock:
+            return {endpoint: dict(endpoint_stats) for endpoint, endpoint_stats in self.stats.items()}
+
+    def log_stats(self):
+        for endpoint, endpoint_stats in self.get_stats().items():
+            avg_latency_ms = endpoint_stats['latency_ms'] / endpoint_stats['calls'] if endpoint_stats['calls'] else 0
+            logger.info(f"Port API stats, endpoint: {endpoint}, calls: {endpoint_stats['calls']},"
+                        f" retries: {endpoint_stats['retries']}, throttles: {endpoint_stats['throttles']},"
+                        f" errors: {endpoint_stats['errors']}, avg latency: {avg_latency_ms:.1f}ms,"
+                        f" max latency: {endpoint_stats['max_latency_ms']:.1f}ms")
+
+    def _refresh_token(self, used_token):
+        with self._token_lock:
+            if self.access_token != used_token:  # Already refreshed by another worker
+                return
+            logger.info("Port access token expired, refreshing it")
+            self.access_token = self.get_token(expired_token=used_token)
+            self.headers = {**self.headers, 'Authorization': f'Bearer {self.access_token}'}
+
+    def _try_upsert_entity(self, entity):
+        try:
+            self.upsert_entity(entity)
+        except Exception as e:
+            return e
+        return None
+
+    def _upsert_batch(self, blueprint_id, entities):
+        if len(entities) == 1 or not self.bulk_upsert_supported:
+            return [self._try_upsert_entity({**entity, 'blueprint': blueprint_id}) for entity in entities]
+
+        if telemetry.should_log_entity():
+            logger.info(f"Upsert {len(entities)} entities of blueprint: {blueprint_id}")
+        try:
+            with telemetry.timer('upsert'):
+                response = self._request('bulk_upsert', 'POST',
+                                         f'{self.api_url}/blueprints/{blueprint_id}/entities/bulk',
+                                         json={'entities': entities}, params={'upsert': 'true', 'merge': 'true'})
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or not 400 <= e.response.status_code < 500 or e.response.status_code == 429:
+                raise
+            errors = [self._try_upsert_entity({**entity, 'blueprint': blueprint_id}) for entity in entities]
+            if e.response.status_code in (404, 405):
+                # Either the blueprint or the bulk endpoint is missing, the single upserts tell which one
+                if not all(errors):
+                    logger.warning("Port API doesn't support bulk upsert, falling back to single entity upserts")
+                    self.bulk_upsert_supported = False
+            else:
+                # One entity that Port rejects fails the whole request, the single upserts tell which ones it is
+                logger.warning(f"Bulk upsert of {len(entities)} entities of blueprint: {blueprint_id} failed with"
+                               f" status: {e.response.status_code}, upserted them one by one, rejected:"
+                               f" {sum(1 for error in errors if error)}")
+            return errors
+
+        # The response has a result for every entity by its index in the batch
+        bulk_response = response.json()
+        errors = [PortEntityError("Entity is missing from the bulk upsert response")] * len(entities)
+        for entity_result in bulk_response.get('entities', []):
+            errors[entity_result['index']] = None
+        for entity_error in bulk_response.get('errors', []):
+            errors[entity_error['index']] = PortEntityError(
+                f"{entity_error.get('statusCode')} {entity_error.get('message') or entity_error.get('error')}",
+                entity_error.get('statusCode'))
+        return errors
+
+    def _record_call(self, endpoint, latency_ms, status_code):
+        with self._lock:
+            endpoint_stats = self.stats[endpoint]
+            endpoint_stats['calls'] += 1
+            endpoint_stats['latency_ms'] += latency_ms
+            endpoint_stats['max_latency_ms'] = max(endpoint_stats['max_latency_ms'], latency_ms)
+            if status_code == 429:
+                endpoint_stats['throttles'] += 1
+            elif status_code is None or status_code >= 400:
+                endpoint_stats['errors'] += 1
+
+    def _record_retry(self, endpoint):
+        with self._lock:
+            self.stats[endpoint]['retries'] += 1
+
+    def _request(self, endpoint, method, url, refresh_token=True, **kwargs):
+        token_refreshed = not refresh_token
+        attempt = 0
+        while True:
+            headers = self.headers if refresh_token else None
+            used_token = self.access_token if refresh_token else None
+            limiter = get_port_limiter(endpoint)
+            limiter.acquire()
+            start_time = time.monotonic()
+            response = None
+            try:
+                response = self.session.request(method, url, headers=headers, timeout=consts.PORT_REQUEST_TIMEOUT,
+                                                **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                request_error = e
+            finally:
+                limiter.release(throttled=response is not None and response.status_code == 429)
+
+            if response is None:
+                self._record_call(endpoint, (time.monotonic() - start_time) * 1000, None)
+                if attempt >= consts.PORT_MAX_RETRIES:
+                    raise request_error
+                delay = self._get_backoff_delay(attempt)
+                logger.warning(
+                    f"Port API request failed, endpoint: {endpoint}, retrying in {delay:.2f}s; {request_error}")
+            else:
+                self._record_call(endpoint, (time.monotonic() - start_time) * 1000, response.status_code)
+                if response.status_code == 429:
+                    telemetry.record_throttle()
+                if response.status_code == 401 and not token_refreshed:
+                    token_refreshed = True
+                    self._refresh_token(used_token)
+                    continue
+                if response.status_code not in consts.PORT_RETRY_STATUS_CODES or attempt >= consts.PORT_MAX_RETRIES:
+                    response.raise_for_status()
+                    return response
+                delay = _parse_retry_after(response.headers.get('Retry-After'))
+                if delay is None:
+                    delay = self._get_backoff_delay(attempt)
+                delay = min(delay, consts.PORT_RETRY_MAX_DELAY)
+                logger.warning(f"Port API request failed, endpoint: {endpoint}, status: {response.status_code},"
+                               f" retrying in {delay:.2f}s")
+
+            self._record_retry(endpoint)
+            attempt += 1
+            time.sleep(delay)
+
+    @staticmethod
+    def _get_backoff_delay(attempt):
+        # Full jitter exponential backoff
+        return random.uniform(0, min(consts.PORT_RETRY_MAX_DELAY, consts.PORT_RETRY_BASE_DELAY * (2 ** attempt)))
@@ -1,32 +1,284 @@
+import functools
+import json
 import jq
 import logging
+import re
+
+import consts
+from port.entities_cache import get_entity_hash
 
 logger = logging.getLogger(__name__)
 
-def handle_entities(entities, port_client, action_type='upsert'):
+ENTITY_JQ_FIELDS = ['identifier', 'title', 'icon', 'team']
+JQ_FIELD_PATTERN = re.compile(r'\.(?:([A-Za-z_][A-Za-z0-9_]*)|"((?:[^"\\]|\\.)*)"|\[\s*"((?:[^"\\]|\\.)*)"\s*\])')
+# Queries that use the whole input, its keys or dynamic paths, which can't be reduced to a set of fields
+JQ_DYNAMIC_ACCESS_PATTERN = re.compile(
+    r'\b(?:getpath|paths|leaf_paths|to_entries|with_entries|keys|keys_unsorted|has|in|tostream|walk)\b'
+    r'|\.\.|\.\[(?!\s*")|(?<![\w\]})"?])\.(?![\w"\[.])|[{,]\s*\$?[A-Za-z_][A-Za-z0-9_]*\s*[,}]')
+# Tokens of a jq query that tell which paths of the input it reads, string literals are split separately
+JQ_PATH_TOKEN_PATTERN = re.compile(
+    r'(?P<field>\.(?:[A-Za-z_][A-Za-z0-9_]*|"(?:[^"\\]|\\.)*")?)|(?P<index>\[\s*(?:"(?:[^"\\]|\\.)*"|-?\d*)\s*\])'
+    r'|(?P<pipe>\|=?)|(?P<open>[([{])|(?P<close>[)\]}])|(?P<separator>[;,])|(?P<optional>\?)'
+    r'|(?P<word>\$?[A-Za-z_][A-Za-z0-9_]*)|(?P<space>\s+)|(?P<other>.)', re.DOTALL)
+JQ_BINDING_PATTERN = re.compile(r'\b(?:as|label)\s*\$[A-Za-z_][A-Za-z0-9_]*\s*$')
+# Functions that run their argument on values inside their input, like the items of a list
+JQ_ITERATING_FUNCTIONS = {'map', 'map_values', 'sort_by', 'group_by', 'unique_by', 'min_by', 'max_by', 'any', 'all',
+                          'until', 'while', 'repeat'}
+# Keywords and functions that don't read their input as a whole. Any other function that is given the whole input,
+# like tostring or del(.A), may read all of it, so the paths can't be told
+JQ_PATH_KEYWORDS = {'if', 'then', 'elif', 'else', 'end', 'as', 'and', 'or', 'not', 'reduce', 'foreach', 'try', 'catch',
+                    'true', 'false', 'null', 'empty', 'select'}
+
+
+def handle_entities(entities, port_client, action_type='upsert', entities_cache=None):
+    # Returns the entities that were handled, and the errors of the entities that Port failed to handle by their keys.
+    # The entities that failed to upsert are still returned as handled, so only they are kept from being deleted as
+    # stale, rather than every entity of the sync. The entities to upsert are sent together, so they can be batched
+    # with the entities of the other workers
     aws_entities = set()
+    failed_entities = {}
+    upserted_entities = []
     for entity in entities:
         blueprint_id = entity.get('blueprint')
         entity_id = entity.get('identifier')
+        entity_key = f"{blueprint_id};{entity_id}"
 
-        aws_entities.add(f"{blueprint_id};{entity_id}")
-
-        try:
-            if action_type == 'upsert':
-                port_client.upsert_entity(entity)
-            elif action_type == 'delete':
+        if action_type == 'upsert':
+            entity_hash = get_entity_hash(entity) if entities_cache else None
+            if entities_cache and entities_cache.is_unchanged(entity_key, entity_hash):
+                aws_entities.add(entity_key)
+                continue
+            upserted_entities.append((entity_key, entity_hash, blueprint_id, entity_id, entity))
+        elif action_type == 'delete':
+            try:
                 port_client.delete_entity(entity)
-        except Exception as e:
-            logger.error(
-                f"Failed to handle entity: {entity_id} of blueprint: {blueprint_id}, action: {action_type}; {e}")
+                aws_entities.add(entity_key)
+            except Exception as e:
+                logger.error(
+                    f"Failed to handle entity: {entity_id} of blueprint: {blueprint_id}, action: {action_type}; {e}")
+                failed_entities[entity_key] = e
 
-    return aws_entities
+    if upserted_entities:
+        errors = port_client.upsert_entities([entity for *_, entity in upserted_entities])
+        for (entity_key, entity_hash, blueprint_id, entity_id, _), error in zip(upserted_entities, errors):
+            aws_entities.add(entity_key)
+            if error:
+                logger.error(
+                    f"Failed to handle entity: {entity_id} of blueprint: {blueprint_id}, action: {action_type}; {error}")
+                failed_entities[entity_key] = error
+            elif entities_cache:
+                entities_cache.update(entity_key, entity_hash)
 
+    return aws_entities, failed_entities
 
-def create_entities_json(resource_object, selector_jq_query, jq_mappings, action_type='upsert'):
-    def run_jq_query(jq_query):
-        return jq.first(jq_query, resource_object)
 
+@functools.lru_cache(maxsize=consts.JQ_PROGRAMS_CACHE_SIZE)
+def compile_jq(jq_query):
+    return jq.compile(jq_query)
+
+
+def run_jq_query(jq_query, value):
+    return compile_jq(jq_query).input_value(value).first()
+
+
+def get_mapping_blueprint(mapping):
+    # The blueprint of a mapping is a quoted string, it isn't evaluated as a jq query
+    return mapping.get('blueprint', '').strip('\"')
+
+
+def get_mappings_queries(selector_jq_query, jq_mappings):
+    queries = [selector_jq_query] if selector_jq_query else []
+    for mapping in jq_mappings:
+        queries.extend(mapping.get(field) for field in ENTITY_JQ_FIELDS if mapping.get(field))
+        queries.extend(mapping.get('properties', {}).values())
+        queries.extend(mapping.get('relations', {}).values())
+    return queries
+
+
+def get_jq_referenced_fields(jq_queries):
+    # Returns the names of all the fields the queries access, or None if it can't be told statically
+    referenced_fields = set()
+    for jq_query in jq_queries:
+        if not isinstance(jq_query, str) or JQ_DYNAMIC_ACCESS_PATTERN.search(jq_query):
+            return None
+        for match in JQ_FIELD_PATTERN.finditer(jq_query):
+            referenced_fields.add(next(group for group in match.groups() if group is not None))
+    return referenced_fields
+
+
+def get_jq_referenced_paths(jq_queries):
+    # Returns the paths of the fields the queries read, or None if it can't be told statically. A path is a tuple of
+    # whether it's read from a value inside the input, like the items in map(), and its field names, where None is
+    # any item of a list
+    if not all(isinstance(jq_query, str) for jq_query in jq_queries) or any(
+            JQ_DYNAMIC_ACCESS_PATTERN.search(jq_query) for jq_query in jq_queries):
+        return None
+    referenced_paths = []
+    for jq_query in jq_queries:
+        if not _add_jq_paths(jq_query, False, referenced_paths):
+            return None
+    return {(relative, tuple(fields)) for relative, fields in referenced_paths if fields}
+
+
+def has_jq_referenced_paths(obj, referenced_paths):
+    # The paths that are read from the input must start at its top level fields. The ones that are read from values
+    # inside it can't be placed statically, so their fields only have to be somewhere in the object
+    object_fields = None
+    for relative, fields in referenced_paths:
+        if not relative:
+            if not _has_path(obj, fields):
+                return False
+            continue
+        object_fields = get_object_fields(obj) if object_fields is None else object_fields
+        if not {field for field in fields if field is not None} <= object_fields:
+            return False
+    return True
+
+
+def get_object_fields(obj, fields=None):
+    fields = set() if fields is None else fields
+    if isinstance(obj, dict):
+        fields.update(obj.keys())
+        for value in obj.values():
+            get_object_fields(value, fields)
+    elif isinstance(obj, list):
+        for value in obj:
+            get_object_fields(value, fields)
+    return fields
+
+
+def _has_path(value, fields):
+    if not fields:
+        return True
+    field = fields[0]
+    if isinstance(value, list):
+        # Some items may not have optional fields, so any item will do. An empty list has nothing to read
+        items_fields = fields[1:] if field is None else fields
+        return not value or any(_has_path(item, items_fields) for item in value)
+    if isinstance(value, dict):
+        if field is None:
+            return not value or any(_has_path(item, fields[1:]) for item in value.values())
+        return field in value and _has_path(value[field], fields[1:])
+    return True  # Reading a field of null gives null, same as in the GetResource properties
+
+
+def _add_jq_paths(jq_query, relative, referenced_paths):
+    # Adds the paths the query reads to referenced_paths as [relative, fields] lists. A path is relative when it's
+    # read after a pipe, in the argument of an iterating function, or from a variable or a parenthesized expression.
+    # Returns False when the query reads the whole input or destructures a value, so its paths can't be told
+    frames = [{'kind': None, 'relative': relative, 'base_relative': relative}]
+    fields = None
+    previous_kind, previous_token = None, None
+    position = 0
+    while position < len(jq_query):
+        frame = frames[-1]
+        if jq_query[position] == '"':
+            position, interpolations = _split_jq_string(jq_query, position)
+            for interpolation in interpolations:
+                if not _add_jq_paths(interpolation, frame['relative'], referenced_paths):
+                    return False
+            fields, previous_kind, previous_token = None, 'value', None
+            continue
+        match = JQ_PATH_TOKEN_PATTERN.match(jq_query, position)
+        position = match.end()
+        kind, token = match.lastgroup, match.group()
+        if kind in ('space', 'optional'):
+            continue
+
+        if kind == 'field':
+            if fields is None:
+                fields = []
+                referenced_paths.append([frame['relative'] or previous_kind in ('value', 'variable'), fields])
+            if len(token) > 1:
+                fields.append(json.loads(token[1:]) if token[1] == '"' else token[1:])
+        elif kind == 'index' and fields is not None:
+            index = token[1:-1].strip()
+            fields.append(json.loads(index) if index.startswith('"') else None)
+        else:
+            fields = None
+        if kind in ('field', 'index') and fields is not None:
+            previous_kind, previous_token = kind, token
+            continue
+
+        next_token = jq_query[position:].lstrip()[:1]
+        if kind == 'word' and not token.startswith('$') and (
+                (token == 'as' and next_token in ('{', '[')) or (
+                token not in JQ_PATH_KEYWORDS and not frame['relative'] and next_token != ':')):
+            return False
+
+        if kind == 'open' or (kind == 'word' and token == 'if'):
+            # The body of reduce and foreach runs on their state, after "as $name"
+            frame_relative = frame['relative'] or previous_token in JQ_ITERATING_FUNCTIONS or (
+                kind == 'open' and previous_kind == 'variable' and JQ_BINDING_PATTERN.search(
+                    jq_query[:match.start()]) is not None)
+            frames.append({'kind': token, 'relative': frame_relative, 'base_relative': frame_relative})
+        elif (kind == 'close' or (kind == 'word' and token == 'end')) and len(frames) > 1:
+            frames.pop()
+        elif kind == 'pipe' and not JQ_BINDING_PATTERN.search(jq_query[:match.start()]):
+            frame['relative'] = True
+        elif (kind == 'separator' and (token == ';' or frame['kind'] == '{')) or (
+                kind == 'word' and token in ('then', 'elif', 'else') and frame['kind'] == 'if'):
+            frame['relative'] = frame['base_relative']
+
+        if kind in ('close', 'index') or (kind == 'word' and token == 'end'):
+            kind = 'value'
+        elif kind == 'word' and token.startswith('$'):
+            kind = 'variable'
+        previous_kind, previous_token = kind, token
+    return True
+
+
+def _split_jq_string(jq_query, start):
+    # Returns the position after the string literal that starts at start, and the queries interpolated in it
+    interpolations = []
+    position = start + 1
+    while position < len(jq_query) and jq_query[position] != '"':
+        if jq_query.startswith('\\(', position):
+            interpolation_start = position = position + 2
+            depth = 1
+            while position < len(jq_query) and depth:
+                if jq_query[position] == '"':
+                    position, _ = _split_jq_string(jq_query, position)
+                    continue
+                depth += {'(': 1, ')': -1}.get(jq_query[position], 0)
+                position += 1
+            interpolations.append(jq_query[interpolation_start:position - 1])
+        else:
+            position += 2 if jq_query[position] == '\\' else 1
+    return position + 1, interpolations
+
+
+@functools.lru_cache(maxsize=consts.JQ_PROGRAMS_CACHE_SIZE)
+def _compile_mapping(mapping_json):
+    # Fuse all the jq queries of a mapping into a single program that emits the whole entity in one pass.
+    # Its first output holds the first output of every query, same as evaluating each one with jq.first
+    mapping = json.loads(mapping_json)
+    queries = [mapping.get('identifier', 'null'), *[mapping.get(field) or 'null' for field in ENTITY_JQ_FIELDS[1:]],
+               *mapping.get('properties', {}).values(), *mapping.get('relations', {}).values()]
+    if not all(isinstance(query, str) for query in queries):
+        return None
+
+    def to_jq_object(fragments):
+        return '{' + ', '.join(f"{json.dumps(key)}: {fragment}" for key, fragment in fragments.items()) + '}'
+
+    def to_jq_term(query):
+        # Wrapped with new lines so a trailing comment in the query won't swallow the rest of the program
+        return f"(\n{query}\n)"
+
+    program = to_jq_object({
+        "identifier": to_jq_term(mapping.get('identifier', 'null')),
+        **{field: to_jq_term(mapping.get(field) or 'null') for field in ENTITY_JQ_FIELDS[1:]},
+        "properties": to_jq_object({key: to_jq_term(query) for key, query in mapping.get('properties', {}).items()}),
+        "relations": to_jq_object({key: to_jq_term(query) for key, query in mapping.get('relations', {}).items()})
+    })
+    try:
+        return jq.compile(program)
+    except Exception as e:
+        logger.warning(f"Failed to compile fused jq program for mapping, falling back to per query evaluation; {e}")
+        return None
+
+
+def create_entities_json(resource_object, selector_jq_query, jq_mappings, action_type='upsert'):
     def raise_missing_exception(missing_field, mapping):
         raise Exception(
             f"Missing required field value for entity, field: {missing_field}, mapping: {mapping.get(missing_field)}")
@@ -34,23 +286,50 @@ def create_entities_json(resource_object, selector_jq_query, jq_mappings, action
     def dedup_list(lst):
         return [dict(tup) for tup in {tuple(obj.items()) for obj in lst}]
 
+    def create_entity_json(mapping):
+        return {k: v for k, v in {
+            "identifier": run_jq_query(mapping.get('identifier', 'null'), resource_object) or raise_missing_exception(
+                'identifier', mapping),
+            "title": run_jq_query(mapping.get('title', 'null'), resource_object) if mapping.get('title') else None,
+            "blueprint": get_mapping_blueprint(mapping) or raise_missing_exception('blueprint', mapping),
+            "icon": run_jq_query(mapping.get('icon', 'null'), resource_object) if mapping.get('icon') else None,
+            "team": run_jq_query(mapping.get('team', 'null'), resource_object) if mapping.get('team') else None,
+            "properties": {prop_key: run_jq_query(prop_val, resource_object) for prop_key, prop_val in
+                           mapping.get('properties', {}).items()},
+            "relations": {rel_key: run_jq_query(rel_val, resource_object) for rel_key, rel_val in
+                          mapping.get('relations', {}).items()} or None
+        }.items() if v is not None}
+
+    def create_fused_entity_json(mapping):
+        blueprint_id = get_mapping_blueprint(mapping)
+        program = _compile_mapping(json.dumps(mapping))
+        if program is None or not blueprint_id:
+            return create_entity_json(mapping)
+        try:
+            result = program.input_value(resource_object).first()
+        except Exception:
+            # Evaluate query by query to raise the same error as before, in the same fields order
+            return create_entity_json(mapping)
+        if not result['identifier']:
+            raise_missing_exception('identifier', mapping)
+
+        return {k: v for k, v in {
+            "identifier": result['identifier'],
+            "title": result['title'],
+            "blueprint": blueprint_id,
+            "icon": result['icon'],
+            "team": result['team'],
+            "properties": result['properties'],
+            "relations": result['relations'] or None
+        }.items() if v is not None}
+
     if action_type == 'delete':
         return dedup_list(
             [{"identifier": resource_object['identifier'],
-              "blueprint": mapping.get('blueprint', '').strip('\"') or raise_missing_exception('blueprint', mapping)}
+              "blueprint": get_mapping_blueprint(mapping) or raise_missing_exception('blueprint', mapping)}
              for mapping in jq_mappings])
 
-    if selector_jq_query and not run_jq_query(selector_jq_query):
+    if selector_jq_query and not run_jq_query(selector_jq_query, resource_object):
         return []
 
-    return [{k: v for k, v in {
-        "identifier": run_jq_query(mapping.get('identifier', 'null')) or raise_missing_exception('identifier', mapping),
-        "title": run_jq_query(mapping.get('title', 'null')) if mapping.get('title') else None,
-        "blueprint": mapping.get('blueprint', '').strip('\"') or raise_missing_exception('blueprint', mapping),
-        "icon": run_jq_query(mapping.get('icon', 'null')) if mapping.get('icon') else None,
-        "team": run_jq_query(mapping.get('team', 'null')) if mapping.get('team') else None,
-        "properties": {prop_key: run_jq_query(prop_val) for prop_key, prop_val in
-                       mapping.get('properties', {}).items()},
-        "relations": {rel_key: run_jq_query(rel_val) for rel_key, rel_val in
-                      mapping.get('relations', {}).items()} or None
-    }.items() if v is not None} for mapping in jq_mappings]
+    return [create_fused_entity_json(mapping) for mapping in jq_mappings]
@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from aws.clients import get_client
+
+logger = logging.getLogger(__name__)
+
+ENTITIES_CACHE_VERSION = 1
+
+
+def get_entity_hash(entity):
+    entity_json = json.dumps(entity, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(entity_json.encode(), digest_size=16).hexdigest()
+
+
+class EntitiesCache:
+    def __init__(self, bucket_name, file_key, full_resync_interval_hours):
+        self.bucket_name = bucket_name
+        self.file_key = file_key
+        self.full_resync_interval = full_resync_interval_hours * 60 * 60
+        self.hashes = {}
+        self.last_full_resync = None
+        self.full_resync = False
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def load(self, is_new_sync):
+        aws_s3_client = get_client('s3')
+        try:
+            cache_from_s3 = json.loads(
+                aws_s3_client.get_object(Bucket=self.bucket_name, Key=self.file_key)['Body'].read())
+        except aws_s3_client.exceptions.NoSuchKey:
+            cache_from_s3 = {}
+        except Exception as e:
+            logger.warning(f"Failed to load entities cache, bucket: {self.bucket_name}, key: {self.file_key}; {e}")
+            cache_from_s3 = {}
+
+        if cache_from_s3.get('version') == ENTITIES_CACHE_VERSION:
+            self.hashes = cache_from_s3.get('hashes', {})
+            self.last_full_resync = cache_from_s3.get('last_full_resync')
+            self.full_resync = cache_from_s3.get('full_resync_in_progress', False)
+
+        if is_new_sync:
+            self.full_resync = not self.last_full_resync or \
+                               time.time() - self.last_full_resync >= self.full_resync_interval
+        if self.full_resync:
+            logger.info("Entities cache is bypassed, all entities will be upserted to Port")
+
+    def save(self):
+        aws_s3_client = get_client('s3')
+        with self._lock:
+            cache = {'version': ENTITIES_CACHE_VERSION, 'last_full_resync': self.last_full_resync,
+                     'full_resync_in_progress': self.full_resync, 'hashes': dict(self.hashes)}
+        try:
+            aws_s3_client.put_object(Body=json.dumps(cache), Bucket=self.bucket_name, Key=self.file_key)
+        except Exception as e:
+            logger.warning(f"Failed to save entities cache, bucket: {self.bucket_name}, key: {self.file_key}; {e}")
+
+    def complete(self, aws_entities):
+        # Called when the whole sync is done, entities that weren't seen are not in AWS anymore
+        with self._lock:
+            self.hashes = {key: entity_hash for key, entity_hash in self.hashes.items() if key in aws_entities}
+            if self.full_resync:
+                self.last_full_resync = time.time()
+                self.full_resync = False
+        self.save()
+
+    def is_unchanged(self, key, entity_hash):
+        with self._lock:
+            unchanged = not self.full_resync and self.hashes.get(key) == entity_hash
+            if unchanged:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return unchanged
+
+    def update(self, key, entity_hash):
+        with self._lock:
+            self.hashes[key] = entity_hash
+
+    def log_stats(self):
+        logger.info(f"Entities cache stats, hits: {self.hits}, misses: {self.misses}, size: {len(self.hashes)},"
+                    f" full resync: {self.full_resync}")
@@ -0,0 +1,98 @@
+import bisect
+import hashlib
+import itertools
+import operator
+from array import array
+
+import consts
+
+
+def get_entity_digest(entity_id):
+    # 64 bits digest of the identifier. A collision can only keep a stale entity from being deleted, never the opposite
+    return int.from_bytes(hashlib.blake2b(entity_id.encode(), digest_size=8).digest(), 'little')
+
+
+def _merge_digests(*digests):
+    # Sorting concatenated sorted runs is close to linear. Duplicates are adjacent once sorted, so a digest is kept
+    # when it differs from the one before it
+    merged = sorted(itertools.chain(*digests))
+    unique = array('Q', merged[:1])
+    unique.extend(itertools.compress(itertools.islice(merged, 1, None),
+                                     map(operator.ne, itertools.islice(merged, 1, None), merged)))
+    return unique
+
+
+class EntitySet:
+    # Compact set of "blueprint;identifier" entity keys, that supports adding, merging and membership tests.
+    # Identifiers are kept as 64 bits digests in a sorted array per blueprint, 8 bytes each instead of a string.
+    # New digests wait in a small set per blueprint, that is sorted into a run of digests once it's full, and the
+    # sorted digests of merged sets are kept as runs too. The runs are merged into the array only when it's read, so
+    # every digest is sorted into it once, however many sets were merged
+    def __init__(self, entity_keys=()):
+        self._digests = {}
+        self._pending = {}
+        self._runs = {}
+        self.update(entity_keys)
+
+    def add(self, entity_key):
+        blueprint_id, entity_id = entity_key.split(';', 1)
+        pending = self._pending.setdefault(blueprint_id, set())
+        pending.add(get_entity_digest(entity_id))
+        if len(pending) >= consts.ENTITY_SET_MAX_PENDING:
+            self._flush_pending(blueprint_id)
+
+    def add_digests(self, blueprint_id, digests):
+        # The digests are sorted, like the chunks of a checkpoint, that follow each other and are appended as is
+        runs = self._runs.setdefault(blueprint_id, [])
+        if runs and digests and digests[0] > runs[-1][-1]:
+            runs[-1].extend(digests)
+        elif digests:
+            runs.append(array('Q', digests))
+
+    def update(self, entities):
+        if isinstance(entities, EntitySet):
+            # Taken as they are, without merging the other set first
+            for blueprint_id, digests in entities._digests.items():
+                self.add_digests(blueprint_id, digests)
+            for blueprint_id, runs in entities._runs.items():
+                for digests in runs:
+                    self.add_digests(blueprint_id, digests)
+            for blueprint_id, other_pending in entities._pending.items():
+                pending = self._pending.setdefault(blueprint_id, set())
+                pending.update(other_pending)
+                if len(pending) >= consts.ENTITY_SET_MAX_PENDING:
+                    self._flush_pending(blueprint_id)
+            return
+        for entity_key in entities:
+            self.add(entity_key)
+
+    def items(self):
+        # Yields the blueprints and the sorted digests of their identifiers
+        for blueprint_id in set(self._pending) | set(self._runs):
+            self._compact(blueprint_id)
+        yield from self._digests.items()
+
+    def __contains__(self, entity_key):
+        blueprint_id, entity_id = entity_key.split(';', 1)
+        entity_digest = get_entity_digest(entity_id)
+        if blueprint_id in self._runs:
+            self._compact(blueprint_id)
+        if entity_digest in self._pending.get(blueprint_id, ()):
+            return True
+        digests = self._digests.get(blueprint_id, ())
+        index = bisect.bisect_left(digests, entity_digest)
+        return index < len(digests) and digests[index] == entity_digest
+
+    def __len__(self):
+        return sum(len(digests) for _, digests in self.items())
+
+    def _flush_pending(self, blueprint_id):
+        self._runs.setdefault(blueprint_id, []).append(array('Q', sorted(self._pending.pop(blueprint_id))))
+
+    def _compact(self, blueprint_id):
+        pending = self._pending.pop(blueprint_id, ())
+        runs = self._runs.pop(blueprint_id, [])
+        if not pending and len(runs) == 1 and not self._digests.get(blueprint_id):
+            self._digests[blueprint_id] = runs[0]
+        elif pending or runs:
+            self._digests[blueprint_id] = _merge_digests(self._digests.get(blueprint_id, ()), pending, *runs)
@@ -0,0 +1,64 @@
+import json
+import threading
+from concurrent.futures import Future, TimeoutError
+
+
+class UpsertBatcher:
+    # Collects the entities that the workers upsert at the same time into batches by blueprint. A batch is sent by
+    # the worker that fills it, or by the first worker that waits for it longer than linger seconds, so no thread is
+    # kept in the background. send_batch(blueprint_id, entities) returns the error of every entity by order, None for
+    # the entities that were upserted
+    def __init__(self, send_batch, max_entities, max_size, linger):
+        self.send_batch = send_batch
+        self.max_entities = max_entities
+        self.max_size = max_size
+        self.linger = linger
+        self._open_batches = {}
+        self._lock = threading.Lock()
+
+    def submit(self, blueprint_id, entity):
+        entity_size = len(json.dumps(entity, default=str))
+        future = Future()
+        full_batches = []
+        with self._lock:
+            batch = self._open_batches.get(blueprint_id)
+            if batch and batch['size'] + entity_size > self.max_size:
+                full_batches.append(self._open_batches.pop(blueprint_id))
+                batch = None
+            if batch is None:
+                batch = {'blueprint_id': blueprint_id, 'entities': [], 'futures': [], 'size': 0}
+                self._open_batches[blueprint_id] = batch
+            batch['entities'].append(entity)
+            batch['futures'].append(future)
+            batch['size'] += entity_size
+            if len(batch['entities']) >= self.max_entities:
+                full_batches.append(self._open_batches.pop(blueprint_id))
+
+        for full_batch in full_batches:
+            self._send(full_batch)
+        return future
+
+    def wait(self, blueprint_id, future):
+        # Returns the error of the entity, None if it was upserted
+        try:
+            return future.result(timeout=self.linger)
+        except TimeoutError:
+            pass
+
+        with self._lock:
+            batch = self._open_batches.get(blueprint_id)
+            if batch and future in batch['futures']:
+                del self._open_batches[blueprint_id]
+            else:  # Already sent by another worker
+                batch = None
+        if batch:
+            self._send(batch)
+        return future.result()
+
+    def _send(self, batch):
+        try:
+            errors = self.send_batch(batch['blueprint_id'], batch['entities'])
+        except Exception as e:
+            errors = [e] * len(batch['entities'])
+        for future, error in zip(batch['futures'], errors):
+            future.set_result(error)
@@ -0,0 +1,95 @@
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+import consts
+from aws.clients import get_client
+
+logger = logging.getLogger(__name__)
+
+# Profiling of an invocation, enabled by "profile": true in the event. The stacks of all the threads are sampled on
+# wall clock time, so waiting for AWS and Port shows as well as jq and JSON, and allocations are traced. Uploaded next
+# to the config file, under profiles/<run id>/<request id>, as a collapsed stacks file for flame graphs and a text
+# file of the top allocation sites. Re-invocations and fan out shards of the run are profiled under the same run id.
+# Tracing allocations slows down allocation heavy code many times over, which skews the stacks towards it, so
+# "profile": {"allocations": false} samples the stacks alone
+
+
+def start(event, lambda_context):
+    # Returns the started profiler, None when the event doesn't ask for profiling
+    profile = event.get('profile')
+    if not profile:
+        return None
+    profile = profile if isinstance(profile, dict) else {}
+    run_id = profile.get('run_id') or lambda_context.aws_request_id
+    trace_allocations = profile.get('allocations', True)
+    event['profile'] = {'run_id': run_id, 'allocations': trace_allocations}  # Passed on to the invocations of the run
+    profiler = Profiler(run_id, lambda_context.aws_request_id, trace_allocations)
+    profiler.start()
+    return profiler
+
+
+class Profiler:
+    def __init__(self, run_id, request_id, trace_allocations):
+        self.run_id = run_id
+        self.request_id = request_id
+        self.trace_allocations = trace_allocations
+        self.stacks = collections.Counter()
+        self.samples_count = 0
+        self.start_time = None
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+
+    def start(self):
+        logger.info(f"Profiling invocation, run: {self.run_id}")
+        if self.trace_allocations:
+            tracemalloc.start(consts.PROFILE_TRACEMALLOC_FRAMES)
+        self.start_time = time.monotonic()
+        self._sampler.start()
+
+    def stop_and_upload(self):
+        self._stopped.set()
+        self._sampler.join()
+        duration = time.monotonic() - self.start_time
+        collapsed_stacks = ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+        allocations = [f"duration: {duration:.1f}s, samples: {self.samples_count}"]
+        if self.trace_allocations and tracemalloc.is_tracing():
+            # The stacks that the profiler itself keeps are left out of the allocations
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)])
+            allocations[0] += f", traced memory peak: {tracemalloc.get_traced_memory()[1] / (1024 * 1024):.1f}MB"
+            tracemalloc.stop()
+            for statistic in snapshot.statistics('traceback')[:consts.PROFILE_TOP_ALLOCATIONS]:
+                allocations.append(f"\n{statistic.size / 1024:.1f}KB in {statistic.count} blocks")
+                allocations.extend(statistic.traceback.format())
+
+        bucket_name = os.getenv('BUCKET_NAME')
+        profile_dir_key = os.path.join(os.path.dirname(os.getenv('CONFIG_JSON_FILE_KEY')), consts.PROFILES_DIR_NAME,
+                                       self.run_id)
+        try:
+            aws_s3_client = get_client('s3')
+            aws_s3_client.put_object(Body=collapsed_stacks, Bucket=bucket_name,
+                                     Key=os.path.join(profile_dir_key, f"{self.request_id}.collapsed"))
+            if self.trace_allocations:
+                aws_s3_client.put_object(Body='\n'.join(allocations), Bucket=bucket_name,
+                                         Key=os.path.join(profile_dir_key, f"{self.request_id}.allocations.txt"))
+            logger.info(f"Uploaded profile, bucket: {bucket_name}, key: {profile_dir_key}/{self.request_id}.*")
+        except Exception as e:
+            logger.warning(f"Failed to upload profile, bucket: {bucket_name}, key: {profile_dir_key}; {e}")
+
+    def _sample(self):
+        sampler_thread_id = threading.get_ident()
+        while not self._stopped.wait(consts.PROFILE_SAMPLE_INTERVAL):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_thread_id:
+                    continue
+                stack = []
+                while frame:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples_count += 1
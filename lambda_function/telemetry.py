@@ -0,0 +1,88 @@
+import contextlib
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+import consts
+
+# Counts, durations, errors and throttles of every phase by kind and region, aggregated in memory and emitted once
+# per invocation as CloudWatch Embedded Metric Format
+_metrics = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'errors': 0, 'throttles': 0})
+_metrics_lock = threading.Lock()
+_local = threading.local()
+_entity_log_sample_rate = 1.0
+
+
+@contextlib.contextmanager
+def scope(kind, region):
+    # Phases that are timed on this thread are recorded under the kind and region
+    previous_dimensions = getattr(_local, 'dimensions', (None, None))
+    _local.dimensions = (kind, region)
+    try:
+        yield
+    finally:
+        _local.dimensions = previous_dimensions
+
+
+@contextlib.contextmanager
+def timer(phase):
+    kind, region = getattr(_local, 'dimensions', (None, None))
+    timers = _local.__dict__.setdefault('timers', [])
+    current_timer = {'throttles': 0}
+    timers.append(current_timer)
+    start_time = time.monotonic()
+    error = False
+    try:
+        yield
+    except Exception:
+        error = True
+        raise
+    finally:
+        timers.pop()
+        with _metrics_lock:
+            phase_metrics = _metrics[(phase, kind, region)]
+            phase_metrics['count'] += 1
+            phase_metrics['duration'] += (time.monotonic() - start_time) * 1000
+            phase_metrics['errors'] += error
+            phase_metrics['throttles'] += current_timer['throttles']
+
+
+def record_throttle():
+    # Counted on the innermost phase that is timed on this thread
+    timers = getattr(_local, 'timers', None)
+    if timers:
+        timers[-1]['throttles'] += 1
+
+
+def set_entity_log_sample_rate(sample_rate):
+    global _entity_log_sample_rate
+    _entity_log_sample_rate = sample_rate
+
+
+def should_log_entity():
+    # Logs of a single entity or resource are sampled, as at scale they cost more than they tell
+    return _entity_log_sample_rate >= 1 or random.random() < _entity_log_sample_rate
+
+
+def emit_metrics():
+    with _metrics_lock:
+        metrics = dict(_metrics)
+        _metrics.clear()
+
+    metrics_by_dimensions = defaultdict(dict)
+    for (phase, kind, region), phase_metrics in metrics.items():
+        metrics_by_dimensions[(kind, region)].update({
+            f"{phase}.count": phase_metrics['count'], f"{phase}.duration": round(phase_metrics['duration'], 1),
+            f"{phase}.errors": phase_metrics['errors'], f"{phase}.throttles": phase_metrics['throttles']})
+
+    timestamp = int(time.time() * 1000)
+    for (kind, region), dimensions_metrics in metrics_by_dimensions.items():
+        dimensions = {name: value for name, value in [('Kind', kind), ('Region', region)] if value}
+        metric_definitions = [{'Name': name, 'Unit': 'Milliseconds' if name.endswith('.duration') else 'Count'}
+                              for name in dimensions_metrics]
+        # Printed rather than logged, as the log format prefix would break the EMF JSON
+        print(json.dumps({'_aws': {'Timestamp': timestamp, 'CloudWatchMetrics': [
+            {'Namespace': consts.METRICS_NAMESPACE, 'Dimensions': [list(dimensions)],
+             'Metrics': metric_definitions}]}, **dimensions, **dimensions_metrics}), flush=True)
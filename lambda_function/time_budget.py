@@ -0,0 +1,64 @@
+import math
+import threading
+
+import consts
+
+_latency_estimators = {}
+_latency_estimators_lock = threading.Lock()
+
+
+class LatencyEstimator:
+    # Exponentially weighted moving averages of the latency and of its deviation, like the TCP retransmission timer.
+    # The estimate is high enough to cover most of the slow calls, not only the average ones
+    def __init__(self, default_latency):
+        self.default_latency = default_latency
+        self.average = None
+        self.deviation = 0.0
+        self._lock = threading.Lock()
+
+    def update(self, latency):
+        with self._lock:
+            if self.average is None:
+                self.average = latency
+                self.deviation = latency / 2
+            else:
+                self.deviation += consts.LATENCY_DEVIATION_EWMA_WEIGHT * (abs(latency - self.average) - self.deviation)
+                self.average += consts.LATENCY_EWMA_WEIGHT * (latency - self.average)
+
+    def estimate(self):
+        with self._lock:
+            if self.average is None:
+                return self.default_latency
+            return self.average + 4 * self.deviation
+
+
+def get_latency_estimator(name, default_latency):
+    # Kept at module level, so the learned latencies are reused across scan units and warm invocations
+    with _latency_estimators_lock:
+        if name not in _latency_estimators:
+            _latency_estimators[name] = LatencyEstimator(default_latency)
+        return _latency_estimators[name]
+
+
+class TimeBudget:
+    # Predicts whether the next page or item of a kind can still be handled before the state has to be saved,
+    # from the latencies seen so far
+    def __init__(self, lambda_context, kind):
+        self.lambda_context = lambda_context
+        self.page_latency = get_latency_estimator(f"{kind}:page", consts.DEFAULT_PAGE_LATENCY)
+        self.item_latency = get_latency_estimator(f"{kind}:item", consts.DEFAULT_ITEM_LATENCY)
+
+    def get_remaining_time(self):
+        # Seconds left until the time that is kept for saving the state and re-invoking the Lambda
+        return (self.lambda_context.get_remaining_time_in_millis() - consts.REMAINING_TIME_TO_REINVOKE_THRESHOLD) / 1000
+
+    def get_drain_time(self, items_count):
+        # The items are handled by the workers concurrently, the ones that are queued wait for a free worker
+        return math.ceil(items_count / consts.MAX_UPSERT_WORKERS) * self.item_latency.estimate()
+
+    def can_start_item(self, in_flight_count):
+        return self.get_drain_time(in_flight_count + 1) < self.get_remaining_time()
+
+    def can_start_page(self, in_flight_count):
+        # The page has to be listed, and at least one of its items handled
+        return self.page_latency.estimate() + self.get_drain_time(in_flight_count + 1) < self.get_remaining_time()
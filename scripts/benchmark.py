@@ -0,0 +1,277 @@
+# Offline benchmark of a whole sync, from app.lambda_handler down to the Port API, against the in-process stand-ins
+# of local_stand_ins.py with synthetic accounts. Every scenario runs in its own process, and the results are compared
+# to the baseline results, so regressions stand out.
+# Usage: python scripts/benchmark.py [--scenario NAME ...] [--save-baseline]
+#        python scripts/benchmark.py --resources 500000 --kinds 10 --regions 4 [--aws-latency SECONDS] ...
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BASELINE_FILE_PATH = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+BUCKET_NAME = 'exporter-bucket'
+CONFIG_JSON_FILE_KEY = 'exporter/config.json'
+FUNCTION_NAME = 'port-aws-exporter'
+LAMBDA_ACCOUNT_ID = '123456789012'
+CLOUDFORMATION_KIND = 'AWS::CloudFormation::Stack'
+KINDS = ['AWS::S3::Bucket', 'AWS::EC2::Instance', 'AWS::Lambda::Function', 'AWS::SQS::Queue', 'AWS::SNS::Topic',
+         'AWS::DynamoDB::Table', 'AWS::RDS::DBInstance', 'AWS::ECS::Cluster', 'AWS::IAM::Role', 'AWS::EKS::Cluster']
+REGIONS = ['us-east-1', 'eu-west-1', 'ap-south-1', 'us-west-2', 'eu-central-1', 'ap-northeast-1']
+
+DEFAULT_SCENARIO = {'resources': 1000, 'kinds': 4, 'regions': 2, 'stacks': 0, 'aws_latency': 0.005,
+                    'port_latency': 0.002, 'aws_throttle_rate': 0.0, 'port_throttle_rate': 0.0, 'budget': 900,
+                    'fan_out': False, 'stale': 100, 'events': 0, 'accounts': 1, 'profile': False,
+                    'invalid': 0, 'malformed': 0, 'denied_accounts': 0}
+SCENARIOS = {
+    'small': {},
+    'medium': {'resources': 20000, 'kinds': 8, 'regions': 4},
+    'throttled': {'resources': 5000, 'aws_throttle_rate': 0.05, 'port_throttle_rate': 0.05},
+    'cloudformation': {'resources': 0, 'stacks': 1000},
+    'reinvoke': {'resources': 20000, 'budget': 4},
+    'fan_out': {'resources': 5000, 'fan_out': True},
+    'sqs_events': {'events': 200, 'stale': 0},
+    'multi_account': {'resources': 8000, 'accounts': 4},
+    'rejected_entities': {'invalid': 10},
+    'malformed_entities': {'malformed': 10},
+    'denied_role': {'resources': 8000, 'accounts': 4, 'denied_accounts': 1},
+}
+# Metrics where a higher value is better, the rest are better when lower
+HIGHER_IS_BETTER = {'resources_per_sec'}
+COMPARED_METRICS = ['resources_per_sec', 'api_calls_per_resource', 'latency_p50_ms', 'latency_p99_ms',
+                    'peak_rss_mb', 'reinvocations', 'cold_invocation_ms', 'warm_invocation_ms']
+
+
+def get_percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))]
+
+
+def run_scenario(scenario):
+    # Runs in the scenario process, as the exporter keeps clients, limiters and caches at module level
+    import logging
+    import resource
+    import time
+
+    sys.path.insert(0, os.path.dirname(__file__))
+    from local_stand_ins import FakeS3, FakeSecretsManager, FakeCloudControl, FakeCloudFormation, FakeLambda, \
+        FakePortServer, FakeSts, install_clients
+
+    os.environ.update(BUCKET_NAME=BUCKET_NAME, CONFIG_JSON_FILE_KEY=CONFIG_JSON_FILE_KEY,
+                      PORT_CREDS_SECRET_ARN='secret')
+    kinds = KINDS[:scenario['kinds']]
+    regions = REGIONS[:scenario['regions']]
+    # The Lambda's own account, and the accounts that are read by assuming a role in them
+    accounts = {LAMBDA_ACCOUNT_ID: None, **{
+        str(210000000000 + account_index): f"arn:aws:iam::{210000000000 + account_index}:role/port-aws-exporter"
+        for account_index in range(1, scenario['accounts'])}}
+    # The last accounts, whose roles can't be assumed. Their resources aren't expected, and their stale entities are
+    # expected to be kept
+    denied_accounts = list(accounts)[len(accounts) - scenario['denied_accounts']:] if \
+        scenario['denied_accounts'] else []
+    resources_per_kind_region = scenario['resources'] // (len(kinds) * len(regions) * len(accounts)) if \
+        scenario['resources'] else 0
+    stacks_per_region = scenario['stacks'] // len(regions)
+    expected_entities = resources_per_kind_region * len(kinds) * len(regions) * (
+            len(accounts) - len(denied_accounts)) + stacks_per_region * len(regions)
+    if scenario['events']:
+        expected_entities = min(scenario['events'], expected_entities)
+
+    port_server = FakePortServer(latency=scenario['port_latency'],
+                                 throttle_rate=scenario['port_throttle_rate']).start()
+    s3 = FakeS3(latency=scenario['aws_latency'])
+    aws_kwargs = {'latency': scenario['aws_latency'], 'throttle_rate': scenario['aws_throttle_rate']}
+    # The roles of the other accounts are assumed through the real session path of aws.clients
+    sts_client = FakeSts(latency=scenario['aws_latency'],
+                         denied_roles=[accounts[account_id] for account_id in denied_accounts])
+    install_clients({('sts', None): sts_client})
+    aws_services = [sts_client]
+    cloudcontrol_clients = {}
+    for region_index, region in enumerate(regions):
+        for account_id, role_arn in accounts.items():
+            if account_id in denied_accounts:
+                continue
+            # The stacks are only in the Lambda's account
+            cloudcontrol_client = FakeCloudControl(region, {kind: resources_per_kind_region for kind in kinds},
+                                                   account_id=account_id if role_arn else None, seed=region_index,
+                                                   **aws_kwargs)
+            cloudformation_client = FakeCloudFormation(region, 0 if role_arn else stacks_per_region,
+                                                       seed=region_index, **aws_kwargs)
+            aws_services.extend([cloudcontrol_client, cloudformation_client])
+            cloudcontrol_clients[(account_id, region)] = cloudcontrol_client
+            install_clients({('cloudcontrol', region, role_arn): cloudcontrol_client,
+                             ('cloudformation', region, role_arn): cloudformation_client})
+    # Port rejects the entities of the first resources of every kind, like a mapping that gives a value the blueprint
+    # doesn't accept. The malformed ones that follow fail the whole bulk upsert request they are in
+    rejected_identifiers = [
+        cloudcontrol_clients[(LAMBDA_ACCOUNT_ID, regions[0])].get_identifier(kinds[rejected_index % len(kinds)],
+                                                                             rejected_index // len(kinds))
+        for rejected_index in range(scenario['invalid'] + scenario['malformed'])]
+    port_server.invalid_identifiers.update(rejected_identifiers[:scenario['invalid']])
+    port_server.malformed_identifiers.update(rejected_identifiers[scenario['invalid']:])
+    install_clients({('s3', None): s3, ('secretsmanager', None): FakeSecretsManager(
+        'client-id', 'client-secret', latency=scenario['aws_latency'])})
+
+    # The import is part of the cold start
+    import_start_time = time.monotonic()
+    import app
+    import_time_ms = (time.monotonic() - import_start_time) * 1000
+    import consts
+
+    # The exporter logs at INFO level in Lambda, so the cost of logging is part of the benchmark
+    logging.basicConfig(stream=open(os.devnull, 'w'), format='%(asctime)s %(name)s %(message)s', force=True)
+    logging.getLogger().setLevel(logging.INFO)
+    # Short budgets keep the same proportions as a 15 minutes invocation
+    time_scale = min(1.0, scenario['budget'] / 900)
+    consts.REMAINING_TIME_TO_REINVOKE_THRESHOLD *= time_scale
+    consts.MIN_REMAINING_TIME_TO_DELETE_STALE_RESOURCES *= time_scale
+    consts.DEFAULT_PAGE_LATENCY *= time_scale
+    consts.DEFAULT_ITEM_LATENCY *= time_scale
+
+    lambda_client = FakeLambda(app.lambda_handler, FUNCTION_NAME, scenario['budget'])
+    install_clients({('lambda', None): lambda_client})
+
+    resources_config = [{'kind': kind, 'selector': {'aws': {'regions': regions}},
+                         'port': {'entity': {'mappings': [{'identifier': '.Identifier', 'title': '.Identifier',
+                                                           'blueprint': f'"{kind.split("::")[1].lower()}"',
+                                                           'properties': {'arn': '.Arn', 'tags': '.Tags'}}]}}}
+                        for kind in kinds if resources_per_kind_region]
+    if stacks_per_region:
+        resources_config.append({'kind': CLOUDFORMATION_KIND, 'selector': {'aws': {'regions': regions}},
+                                 'port': {'entity': {'mappings': [
+                                     {'identifier': '.StackName', 'title': '.StackName', 'blueprint': '"stack"',
+                                      'properties': {'status': '.StackStatus',
+                                                     'resources': '[.StackResources[].LogicalResourceId]'}}]}}})
+    config = {'port_api_url': port_server.api_url, 'fan_out': {'enabled': scenario['fan_out']},
+              'resources': resources_config}
+    if scenario['accounts'] > 1:
+        config['accounts'] = [{'id': account_id, 'role_arn': role_arn} if role_arn else {'id': account_id}
+                              for account_id, role_arn in accounts.items()]
+    s3.put_object(Body=json.dumps(config), Bucket=BUCKET_NAME, Key=CONFIG_JSON_FILE_KEY)
+
+    # Stale entities are only searched in the blueprints of the mappings
+    stale_blueprint = resources_config[0]['port']['entity']['mappings'][0]['blueprint'].strip('"')
+    for stale_index in range(scenario['stale']):
+        account_id = list(accounts)[stale_index % len(accounts)]
+        datasource = f"{consts.PORT_AWS_EXPORTER_NAME}/0.1 (accountid/{account_id} region/us-east-1)"
+        port_server.add_entity(stale_blueprint, f"stale-{stale_index}", datasource)
+
+    invocation_latencies = []
+    start_time = time.monotonic()
+    if scenario['events']:
+        # Every event is handled by its own invocation, like the SQS events of single resources
+        for event_index in range(scenario['events']):
+            kind = kinds[event_index % len(kinds)]
+            region = regions[event_index // len(kinds) % len(regions)]
+            identifier = cloudcontrol_clients[(LAMBDA_ACCOUNT_ID, region)].get_identifier(
+                kind, event_index // (len(kinds) * len(regions)) % resources_per_kind_region)
+            event_body = {'resource_type': kind, 'region': f'"{region}"', 'identifier': f'"{identifier}"'}
+            invocation_start_time = time.monotonic()
+            lambda_client.run({'Records': [{'messageId': str(event_index), 'body': json.dumps(event_body)}],
+                               'profile': scenario['profile']})
+            invocation_latencies.append((time.monotonic() - invocation_start_time) * 1000)
+    else:
+        lambda_client.run({'profile': scenario['profile']})
+        lambda_client.wait()
+    elapsed = time.monotonic() - start_time
+    port_server.stop()
+
+    listed_at = {}
+    for aws_service in aws_services:
+        listed_at.update(aws_service.listed_at)
+    latencies = sorted((port_server.upserted_at[identifier] - listed_time) * 1000
+                       for identifier, listed_time in listed_at.items() if identifier in port_server.upserted_at)
+    aws_calls = sum(aws_service.calls for aws_service in aws_services)
+    stale_accounts = {f"stale-{stale_index}": list(accounts)[stale_index % len(accounts)]
+                      for stale_index in range(scenario['stale'])}
+    stale_left = sum(1 for blueprint_id, identifier in port_server.entities
+                     if identifier in stale_accounts and stale_accounts[identifier] not in denied_accounts)
+    stale_kept = sum(1 for blueprint_id, identifier in port_server.entities
+                     if identifier in stale_accounts and stale_accounts[identifier] in denied_accounts)
+    profiles_dir_key = os.path.join(os.path.dirname(CONFIG_JSON_FILE_KEY), consts.PROFILES_DIR_NAME, '')
+    return {'entities': expected_entities, 'elapsed_sec': round(elapsed, 2),
+            'resources_per_sec': round(expected_entities / elapsed, 1),
+            'aws_calls': aws_calls, 'aws_throttles': sum(aws_service.throttles for aws_service in aws_services),
+            'port_requests': port_server.requests, 'port_throttles': port_server.throttles,
+            'api_calls_per_resource': round((aws_calls + port_server.requests) / max(expected_entities, 1), 3),
+            'latency_p50_ms': round(get_percentile(latencies, 50), 1),
+            'latency_p99_ms': round(get_percentile(latencies, 99), 1),
+            'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'reinvocations': lambda_client.invocations - max(scenario['events'], 1),
+            'errors': len(lambda_client.errors),
+            'missing_entities': expected_entities - len(rejected_identifiers) - len(port_server.upserted_at),
+            'stale_left': stale_left, 'stale_kept': stale_kept, 'assumed_roles': len(set(sts_client.assumed_roles)),
+            'profiles': sum(1 for _, key in s3.objects if key.startswith(profiles_dir_key)),
+            'cold_invocation_ms': round(import_time_ms + invocation_latencies[0], 1) if invocation_latencies else None,
+            'warm_invocation_ms': round(get_percentile(sorted(invocation_latencies[1:]), 50), 1)
+            if invocation_latencies else None}
+
+
+def run_scenario_process(name, scenario):
+    completed_process = subprocess.run([sys.executable, __file__, '--run-scenario', json.dumps(scenario)],
+                                       capture_output=True, text=True)
+    if completed_process.returncode != 0:
+        raise RuntimeError(f"Scenario {name} failed:\n{completed_process.stderr}")
+    return json.loads(completed_process.stdout.strip().splitlines()[-1])
+
+
+def print_results(name, results, baseline_results):
+    print(f"{name}: {results['entities']} entities in {results['elapsed_sec']}s, errors: {results['errors']},"
+          f" missing: {results['missing_entities']}, stale left: {results['stale_left']},"
+          f" aws calls: {results['aws_calls']} (throttled {results['aws_throttles']}),"
+          f" port requests: {results['port_requests']} (throttled {results['port_throttles']})"
+          f"{', assumed roles: ' + str(results['assumed_roles']) if results.get('assumed_roles') else ''}"
+          f"{', stale kept: ' + str(results['stale_kept']) if results.get('stale_kept') else ''}"
+          f"{', profile files: ' + str(results['profiles']) if results.get('profiles') else ''}")
+    for metric in COMPARED_METRICS:
+        if results.get(metric) is None:
+            continue
+        line = f"  {metric:<24}{results[metric]:>12}"
+        if baseline_results and baseline_results.get(metric):
+            change = (results[metric] - baseline_results[metric]) / baseline_results[metric] * 100
+            better = change >= 0 if metric in HIGHER_IS_BETTER else change <= 0
+            line += f"{baseline_results[metric]:>12}  {change:+.1f}%{'' if better or abs(change) < 10 else ' !'}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="Scenarios to run, all by default")
+    parser.add_argument('--save-baseline', action='store_true', help="Save the results as the new baseline")
+    parser.add_argument('--run-scenario', help=argparse.SUPPRESS)
+    for option, value in DEFAULT_SCENARIO.items():
+        if isinstance(value, bool):
+            parser.add_argument(f"--{option.replace('_', '-')}", action='store_true', default=None)
+        else:
+            parser.add_argument(f"--{option.replace('_', '-')}", type=type(value))
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        print(json.dumps(run_scenario(json.loads(args.run_scenario))))
+        return
+
+    custom_scenario = {option: getattr(args, option) for option in DEFAULT_SCENARIO if
+                       getattr(args, option) is not None}
+    scenarios = {'custom': custom_scenario} if custom_scenario else {
+        name: SCENARIOS[name] for name in (args.scenario or SCENARIOS)}
+    baseline = {}
+    if os.path.exists(BASELINE_FILE_PATH):
+        with open(BASELINE_FILE_PATH) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    print(f"  {'metric':<24}{'current':>12}{'baseline':>12}  change")
+    all_results = {}
+    for name, scenario in scenarios.items():
+        all_results[name] = run_scenario_process(name, {**DEFAULT_SCENARIO, **scenario})
+        print_results(name, all_results[name], baseline.get(name))
+
+    if args.save_baseline:
+        with open(BASELINE_FILE_PATH, 'w') as baseline_file:
+            json.dump({**baseline, **all_results}, baseline_file, indent=2)
+            baseline_file.write('\n')
+        print(f"Saved baseline results to {BASELINE_FILE_PATH}")
+
+
+if __name__ == '__main__':
+    main()
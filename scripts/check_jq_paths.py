@@ -0,0 +1,135 @@
+# Checks the jq paths analyzer that decides whether properties_source 'auto' can use the ListResources properties
+# instead of GetResource. Every query is checked for the paths it's expected to read, or None when it has to fall back
+# to GetResource. The queries with paths are then run on a resource, and on every copy of the resource with one of its
+# properties removed that the analyzer would accept as listed properties, which must give the same result. A property
+# is removed from all the items of a list, like ListResources leaves it out, and the properties inside the value at
+# the end of a path aren't removed, as that value is read as it's listed. Runs offline.
+# Usage: python scripts/check_jq_paths.py
+import copy
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_function'))
+
+from port.entities import compile_jq, get_jq_referenced_paths, has_jq_referenced_paths  # noqa: E402
+
+RESOURCE = {'Arn': 'arn:aws:ec2:us-east-1:123456789012:instance/i-0abc', 'InstanceId': 'i-0abc', 'State': 'running',
+            'Placement': {'AvailabilityZone': 'us-east-1a', 'Tenancy': 'default'},
+            'Tags': [{'Key': 'env', 'Value': 'prod'}, {'Key': 'team', 'Value': 'core'}],
+            'SecurityGroups': [{'GroupId': 'sg-1', 'GroupName': 'web'}], 'Monitoring': None}
+
+# Query, the paths it reads as (relative, fields) or None, and whether a relative path may match a field of the same
+# name elsewhere in the resource, which is an accepted approximation that the removal check doesn't apply to
+CASES = [
+    ('.Arn', {(False, ('Arn',))}, False),
+    ('.Placement.AvailabilityZone', {(False, ('Placement', 'AvailabilityZone'))}, False),
+    ('.["Placement"].Tenancy', {(False, ('Placement', 'Tenancy'))}, False),
+    ('."Arn"', {(False, ('Arn',))}, False),
+    ('.Monitoring?.State', {(False, ('Monitoring', 'State'))}, False),
+    ('.Tags[].Key', {(False, ('Tags', None, 'Key'))}, False),
+    ('.Tags[0].Value', {(False, ('Tags', None, 'Value'))}, False),
+    ('.Tags[] | .Value', {(False, ('Tags', None)), (True, ('Value',))}, False),
+    ('.Tags | map(.Key)', {(False, ('Tags',)), (True, ('Key',))}, False),
+    ('[.Tags[] | select(.Key == "env") | .Value][0]',
+     {(False, ('Tags', None)), (True, ('Key',)), (True, ('Value',))}, False),
+    ('.Tags | any(.Key == "team")', {(False, ('Tags',)), (True, ('Key',))}, False),
+    ('[.SecurityGroups[].GroupId] | join(",")', {(False, ('SecurityGroups', None, 'GroupId'))}, False),
+    ('{arn: .Arn, id: .InstanceId}', {(False, ('Arn',)), (False, ('InstanceId',))}, False),
+    ('{"arn": .Arn}', {(False, ('Arn',))}, False),
+    ('"\\(.InstanceId)-\\(.State)"', {(False, ('InstanceId',)), (False, ('State',))}, False),
+    ('"\\(.State | ascii_upcase)"', {(False, ('State',))}, False),
+    ('.Missing // .Arn', {(False, ('Missing',)), (False, ('Arn',))}, False),
+    ('if .State == "running" then .Arn else .InstanceId end',
+     {(False, ('State',)), (False, ('Arn',)), (False, ('InstanceId',))}, False),
+    ('.Placement as $placement | $placement.Tenancy', {(False, ('Placement',)), (True, ('Tenancy',))}, False),
+    ('.Tags | length', {(False, ('Tags',))}, False),
+    ('.Placement | tojson', {(False, ('Placement',))}, False),
+    ('try .Arn catch null', {(False, ('Arn',))}, False),
+    ('.State == "running" and (.Monitoring | not)', {(False, ('State',)), (False, ('Monitoring',))}, False),
+    ('select(.State == "running") | .InstanceId', {(False, ('State',)), (True, ('InstanceId',))}, True),
+    # The whole input
+    ('.', None, False),
+    ('tostring', None, False),
+    ('length', None, False),
+    ('@base64', None, False),
+    ('"\\(tostring)"', None, False),
+    ('del(.Tags)', None, False),
+    ('.Placement | if . then 1 else 0 end', None, False),
+    # Its keys or dynamic access
+    ('keys', None, False),
+    ('.Placement | keys', None, False),
+    ('to_entries', None, False),
+    ('has("Arn")', None, False),
+    ('paths', None, False),
+    ('..', None, False),
+    ('.[]', None, False),
+    ('.[.State]', None, False),
+    ('getpath(["Arn"])', None, False),
+    ('any(.Tags[]; .Key == "env")', None, False),
+    ('def arn: .Arn; arn', None, False),
+    ('reduce .Tags[] as $tag ({}; . + {($tag.Key): $tag.Value})', None, False),
+    ('.Placement as {Tenancy: $tenancy} | $tenancy', None, False),
+    # Object shorthand, that reads the fields of the input by their keys
+    ('{Arn}', None, False),
+    ('{Arn, State}', None, False),
+    ('.Placement | {Tenancy}', None, False),
+]
+
+
+def get_property_paths(value, path=()):
+    # Yields the paths of all the properties at any depth, where None is every item of a list
+    property_paths = []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            property_paths.append(path + (key,))
+            property_paths.extend(get_property_paths(item, path + (key,)))
+    elif isinstance(value, list):
+        for item in value:
+            property_paths.extend(get_property_paths(item, path + (None,)))
+    return list(dict.fromkeys(property_paths))
+
+
+def remove_property(value, path):
+    if isinstance(value, list) and path[0] is None:
+        for item in value:
+            remove_property(item, path[1:])
+    elif isinstance(value, dict) and len(path) == 1:
+        value.pop(path[0], None)
+    elif isinstance(value, dict) and path[0] in value:
+        remove_property(value[path[0]], path[1:])
+
+
+def is_inside_read_value(property_path, referenced_paths):
+    return any(not relative and len(fields) < len(property_path) and property_path[:len(fields)] == fields
+               for relative, fields in referenced_paths)
+
+
+def run_query(jq_query, value):
+    try:
+        return compile_jq(jq_query).input_value(value).all()
+    except Exception as e:
+        return type(e).__name__
+
+
+failures = []
+for jq_query, expected_paths, approximate in CASES:
+    referenced_paths = get_jq_referenced_paths([jq_query])
+    if referenced_paths != expected_paths:
+        failures.append(f"{jq_query}: paths {referenced_paths}, expected {expected_paths}")
+        continue
+    if referenced_paths is None or approximate:
+        continue
+    expected_result = run_query(jq_query, RESOURCE)
+    for removed_path in get_property_paths(RESOURCE):
+        if is_inside_read_value(removed_path, referenced_paths):
+            continue
+        listed_resource = copy.deepcopy(RESOURCE)
+        remove_property(listed_resource, removed_path)
+        if has_jq_referenced_paths(listed_resource, referenced_paths) and \
+                run_query(jq_query, listed_resource) != expected_result:
+            failures.append(f"{jq_query}: accepted the resource without {removed_path}, which changes the result")
+
+print(f"queries: {len(CASES)}, failures: {len(failures)}")
+for failure in failures:
+    print(f"  {failure}")
+sys.exit(1 if failures else 0)
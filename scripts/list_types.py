@@ -1,22 +1,104 @@
-import boto3
+# Probes every public resource type with CloudControl, concurrently in every region, and writes a versioned
+# capability catalog per region: whether the type can be listed, and the resource model properties that listing
+# requires. A type is unsupported only when CloudControl says so or its schema has no list handler, any other error
+# leaves it unknown, and it's still scanned.
+# The exporter skips the types that can't be listed, before any API call, once the catalogs are uploaded to the
+# capability_catalog directory next to its config file.
+# Usage: python scripts/list_types.py [--regions REGION ...] [--output-dir DIR] [--bucket BUCKET --prefix PREFIX]
+#        PREFIX is the directory of the config file followed by /capability_catalog
+import argparse
+import datetime
+import json
+import os
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-client = boto3.client('cloudcontrol')
-cfn = boto3.client('cloudformation')
-type_names = [t['TypeName'] for t in
-              cfn.get_paginator('list_types').paginate(Type='RESOURCE', Visibility='PUBLIC').build_full_result()[
-                  'TypeSummaries']]
-supported = {}
+from botocore.exceptions import ClientError
 
-for t in type_names:
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_function'))
+
+import consts  # noqa: E402
+from aws.clients import get_client  # noqa: E402
+from capability_catalog import create_catalog, get_catalog_file_key  # noqa: E402
+from concurrency import call_aws, get_aws_limiter  # noqa: E402
+
+
+def get_type_names(region):
+    aws_cloudformation_client = get_client('cloudformation', region_name=region)
+    type_names = []
+    for page in aws_cloudformation_client.get_paginator('list_types').paginate(Type='RESOURCE', Visibility='PUBLIC'):
+        type_names.extend(type_summary['TypeName'] for type_summary in page['TypeSummaries'])
+    return type_names
+
+
+def probe_type(region, type_name):
+    # Calls go through the adaptive concurrency limiters of the exporter, so the probes back off when throttled.
+    # "list" is None when the probe failed for another reason, like throttling or missing permissions
+    aws_cloudformation_client = get_client('cloudformation', region_name=region)
+    aws_cloudcontrol_client = get_client('cloudcontrol', region_name=region)
+    cloudformation_limiter = get_aws_limiter('cloudformation', region)
+    cloudcontrol_limiter = get_aws_limiter('cloudcontrol', region)
+    capabilities = {'list': None, 'required_resource_model': []}
     try:
-        result = client.list_resources(TypeName=t)
-        supported[t] = True
-        print('type: %s success' % t)
-    except client.exceptions.UnsupportedActionException:
-        supported[t] = False
-        print('type: %s unsupported' % t)
+        schema = json.loads(call_aws(cloudformation_limiter, aws_cloudformation_client.describe_type, Type='RESOURCE',
+                                     TypeName=type_name)['Schema'])
+        list_handler = schema.get('handlers', {}).get('list')
+        if not list_handler:
+            return {**capabilities, 'list': False, 'error': 'NoListHandler'}
+        capabilities['required_resource_model'] = list_handler.get('handlerSchema', {}).get('required', [])
+        if capabilities['required_resource_model']:  # Can't be listed without a resource model to probe with
+            return {**capabilities, 'list': True}
+
+        call_aws(cloudcontrol_limiter, aws_cloudcontrol_client.list_resources, TypeName=type_name)
+        capabilities['list'] = True
+    except ClientError as e:
+        capabilities['error'] = e.response.get('Error', {}).get('Code')
+        if capabilities['error'] == 'UnsupportedActionException':
+            capabilities['list'] = False
     except Exception as e:
-        supported[t] = False
-        print('type: %s error: %s' % (t, e))
+        capabilities['error'] = type(e).__name__
+    return capabilities
+
+
+def get_support_status(capabilities):
+    return {True: 'supported', False: 'unsupported', None: 'unknown'}[capabilities['list']]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--regions', nargs='+', default=[os.getenv('AWS_DEFAULT_REGION', 'us-east-1')])
+    parser.add_argument('--output-dir', default='capability_catalog', help="Local directory of the catalogs")
+    parser.add_argument('--bucket', help="Bucket to upload the catalogs to, the bucket of the exporter config")
+    parser.add_argument('--prefix', default=consts.CAPABILITY_CATALOG_DIR_NAME, help="Directory of the catalogs")
+    parser.add_argument('--workers', type=int, default=consts.MAX_UPSERT_WORKERS)
+    args = parser.parse_args()
+
+    created_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    catalogs_types = defaultdict(dict)
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(probe_type, region, type_name): (region, type_name)
+                   for region, type_names in zip(args.regions, executor.map(get_type_names, args.regions))
+                   for type_name in type_names}
+        for completed_future in as_completed(futures):
+            region, type_name = futures[completed_future]
+            capabilities = completed_future.result()
+            catalogs_types[region][type_name] = capabilities
+            print(f"region: {region}, type: {type_name}, {get_support_status(capabilities)}"
+                  f"{', error: ' + capabilities['error'] if capabilities.get('error') else ''}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for region in args.regions:
+        types = dict(sorted(catalogs_types[region].items()))
+        catalog_json = json.dumps(create_catalog(region, types, created_at), indent=2)
+        with open(get_catalog_file_key(args.output_dir, region), 'w') as catalog_file:
+            catalog_file.write(catalog_json)
+        if args.bucket:
+            get_client('s3').put_object(Body=catalog_json, Bucket=args.bucket,
+                                        Key=get_catalog_file_key(args.prefix, region))
+        print(f"region: {region}, supported {sum(1 for capabilities in types.values() if capabilities['list'])},"
+              f" unknown {sum(1 for capabilities in types.values() if capabilities['list'] is None)} of {len(types)}")
+
 
-print('supported %d of %d' % (sum(supported.values()), len(supported)))
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,435 @@
+# In-process stand-ins for the AWS services and the Port API that the exporter uses, so a whole sync can run
+# locally without any AWS or Port account. Used by the simulation and benchmark scripts.
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from botocore.exceptions import ClientError
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_function'))
+
+import aws.clients  # noqa: E402
+
+
+def _client_error(code, operation_name):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation_name)
+
+
+class FakeS3:
+    class exceptions:
+        class NoSuchKey(ClientError):
+            def __init__(self):
+                super().__init__({'Error': {'Code': 'NoSuchKey', 'Message': 'NoSuchKey'}}, 'GetObject')
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        time.sleep(self.latency)
+        with self._lock:
+            if (Bucket, Key) not in self.objects:
+                raise self.exceptions.NoSuchKey()
+            body = self.objects[(Bucket, Key)]
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if IfNoneMatch == etag:
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'},
+                               'ResponseMetadata': {'HTTPStatusCode': 304}}, 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': etag}
+
+    def put_object(self, Body, Bucket, Key, IfNoneMatch=None):
+        with self._lock:
+            if IfNoneMatch == '*' and (Bucket, Key) in self.objects:
+                raise _client_error('PreconditionFailed', 'PutObject')
+            self.objects[(Bucket, Key)] = Body.encode() if isinstance(Body, str) else Body
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket, Key):
+        self.put_object(Fileobj.read(), Bucket, Key)
+
+    def delete_object(self, Bucket, Key):
+        with self._lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        for s3_object in Delete['Objects']:
+            self.delete_object(Bucket, s3_object['Key'])
+        return {}
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix=''):
+        with self._lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        yield {'Contents': [{'Key': key} for key in keys]}
+
+    def keys(self, bucket_name):
+        with self._lock:
+            return sorted(key for bucket, key in self.objects if bucket == bucket_name)
+
+
+class FakeSecretsManager:
+    def __init__(self, client_id, client_secret, latency=0.0):
+        self.secret = json.dumps({'id': client_id, 'clientSecret': client_secret})
+        self.latency = latency
+
+    def get_secret_value(self, SecretId):
+        time.sleep(self.latency)
+        return {'SecretString': self.secret}
+
+
+class FakeAwsService:
+    # Every call takes latency seconds, and is throttled at throttle_rate. The time a resource was first listed is
+    # kept by its identifier, to measure how long it took to get to Port
+    def __init__(self, region, latency=0.0, throttle_rate=0.0, seed=0):
+        self.region = region
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.calls = 0
+        self.throttles = 0
+        self.listed_at = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # Set by install_clients to the assumed role credentials of a stand-in of another account
+        self.credentials = None
+
+    def _call(self, operation_name):
+        if self.credentials is not None:
+            self.credentials.get_frozen_credentials()  # Refreshes the credentials when they expire, like boto3 does
+        with self._lock:
+            self.calls += 1
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+        time.sleep(self.latency)
+        if throttled:
+            raise _client_error('ThrottlingException', operation_name)
+
+    def _record_listed(self, identifiers):
+        listed_at = time.monotonic()
+        with self._lock:
+            for identifier in identifiers:
+                self.listed_at.setdefault(identifier, listed_at)
+
+
+class FakeSts(FakeAwsService):
+    # Issues credentials that expire after duration seconds, and counts the roles that were assumed. The roles in
+    # denied_roles can't be assumed, like a role that doesn't trust the Lambda execution role
+    def __init__(self, duration=3600, denied_roles=(), **kwargs):
+        super().__init__(None, **kwargs)
+        self.duration = duration
+        self.denied_roles = set(denied_roles)
+        self.assumed_roles = []
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        self._call('AssumeRole')
+        if RoleArn in self.denied_roles:
+            raise _client_error('AccessDenied', 'AssumeRole')
+        with self._lock:
+            self.assumed_roles.append(RoleArn)
+        return {'Credentials': {'AccessKeyId': f"ASIA{uuid.uuid4().hex[:16].upper()}",
+                                'SecretAccessKey': uuid.uuid4().hex, 'SessionToken': uuid.uuid4().hex,
+                                'Expiration': datetime.now(timezone.utc) + timedelta(seconds=self.duration)}}
+
+
+class FakeCloudControl(FakeAwsService):
+    # resources_count_by_kind resources of every kind, listed page_size at a time. The identifiers of an account_id
+    # are unique to it, for the stand-ins of the accounts of a multi account sync
+    def __init__(self, region, resources_count_by_kind, page_size=100, account_id=None, **kwargs):
+        super().__init__(region, **kwargs)
+        self.resources_count_by_kind = resources_count_by_kind
+        self.page_size = page_size
+        self.account_id = account_id
+
+    def get_identifier(self, type_name, index):
+        account_prefix = f"{self.account_id}-" if self.account_id else ''
+        return f"{account_prefix}{type_name.replace('::', '-').lower()}-{self.region}-{index}"
+
+    def _get_properties(self, type_name, index):
+        identifier = self.get_identifier(type_name, index)
+        return {'Identifier': identifier, 'Arn': f"arn:aws:{self.region}:{identifier}",
+                'Tags': [{'Key': 'index', 'Value': str(index)}]}
+
+    def list_resources(self, TypeName, ResourceModel=None, NextToken=None):
+        self._call('ListResources')
+        resources_count = self.resources_count_by_kind.get(TypeName, 0)
+        start = int(NextToken or 0)
+        end = min(start + self.page_size, resources_count)
+        resources = [self._get_properties(TypeName, index) for index in range(start, end)]
+        self._record_listed(resource['Identifier'] for resource in resources)
+        return {'TypeName': TypeName,
+                'ResourceDescriptions': [{'Identifier': resource['Identifier'], 'Properties': json.dumps(resource)}
+                                         for resource in resources],
+                'NextToken': str(end) if end < resources_count else None}
+
+    def get_resource(self, TypeName, Identifier):
+        self._call('GetResource')
+        index = int(Identifier.rsplit('-', 1)[1])
+        if index >= self.resources_count_by_kind.get(TypeName, 0):
+            raise _client_error('ResourceNotFoundException', 'GetResource')
+        return {'TypeName': TypeName, 'ResourceDescription': {
+            'Identifier': Identifier, 'Properties': json.dumps(self._get_properties(TypeName, index))}}
+
+
+class FakeCloudFormation(FakeAwsService):
+    # stacks_count stacks, described page_size at a time, each with a few resources and a template
+    def __init__(self, region, stacks_count, page_size=100, **kwargs):
+        super().__init__(region, **kwargs)
+        self.stacks_count = stacks_count
+        self.page_size = page_size
+
+    def _get_stack(self, index):
+        stack_name = f"stack-{self.region}-{index}"
+        return {'StackId': f"arn:aws:cloudformation:{self.region}:123456789012:stack/{stack_name}/{index}",
+                'StackName': stack_name, 'StackStatus': 'CREATE_COMPLETE', 'CreationTime': '2024-01-01T00:00:00Z',
+                'Tags': [{'Key': 'index', 'Value': str(index)}]}
+
+    def describe_stacks(self, NextToken=None, StackName=None):
+        self._call('DescribeStacks')
+        if StackName:
+            return {'Stacks': [self._get_stack(int(StackName.rsplit('/', 1)[1]))]}
+        start = int(NextToken or 0)
+        end = min(start + self.page_size, self.stacks_count)
+        stacks = [self._get_stack(index) for index in range(start, end)]
+        self._record_listed(stack['StackName'] for stack in stacks)
+        return {'Stacks': stacks, 'NextToken': str(end) if end < self.stacks_count else None}
+
+    def describe_stack_resources(self, StackName):
+        self._call('DescribeStackResources')
+        return {'StackResources': [{'LogicalResourceId': f"Resource{index}", 'ResourceType': 'AWS::S3::Bucket',
+                                    'ResourceStatus': 'CREATE_COMPLETE'} for index in range(3)]}
+
+    def get_template(self, StackName):
+        self._call('GetTemplate')
+        return {'TemplateBody': {'Resources': {f"Resource{index}": {'Type': 'AWS::S3::Bucket'} for index in range(3)}}}
+
+
+class FakeContext:
+    def __init__(self, function_name, budget_seconds, region='us-east-1', account_id='123456789012'):
+        self.function_name = function_name
+        self.invoked_function_arn = f"arn:aws:lambda:{region}:{account_id}:function:{function_name}"
+        self.aws_request_id = str(uuid.uuid4())
+        self._deadline = time.monotonic() + budget_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
+
+
+class FakeLambda:
+    # Event invocations run the handler on a new thread, with a fresh context, like an asynchronous Lambda invoke
+    def __init__(self, lambda_handler, function_name, budget_seconds, fail_payload=None):
+        self.lambda_handler = lambda_handler
+        self.function_name = function_name
+        self.budget_seconds = budget_seconds
+        self.fail_payload = fail_payload
+        self.invocations = 0
+        self.errors = []
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        assert InvocationType == 'Event'
+        thread = threading.Thread(target=self.run, args=(json.loads(Payload),))
+        with self._lock:
+            self._threads.append(thread)
+        thread.start()
+        return {'StatusCode': 202}
+
+    def run(self, event):
+        with self._lock:
+            self.invocations += 1
+        try:
+            if self.fail_payload and self.fail_payload(event):
+                raise RuntimeError(f"Simulated failure of invocation: {event}")
+            return self.lambda_handler(event, FakeContext(self.function_name, self.budget_seconds))
+        except Exception as e:
+            with self._lock:
+                self.errors.append(e)
+
+    def wait(self):
+        while True:
+            with self._lock:
+                threads = [thread for thread in self._threads if thread.is_alive()]
+            if not threads:
+                return
+            for thread in threads:
+                thread.join()
+
+
+class FakePortServer:
+    # Keeps the entities in memory, and serves the endpoints of the Port API that the exporter calls. Every request
+    # takes latency seconds, and is throttled with a 429 at throttle_rate. Entities with invalid_identifiers are
+    # rejected with a 422. Entities with malformed_identifiers are rejected with a 422 too, and fail the whole bulk
+    # upsert request they are in with a 400. The bulk upsert endpoint can be left out to serve like an older Port API
+    def __init__(self, latency=0.0, throttle_rate=0.0, seed=0, invalid_identifiers=(), malformed_identifiers=(),
+                 bulk_upsert=True):
+        self.entities = {}
+        self.upserted_at = {}
+        self.requests = 0
+        self.throttles = 0
+        self.upserts = 0
+        self.bulk_upserts = 0
+        self.deletes = 0
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.invalid_identifiers = set(invalid_identifiers)
+        self.malformed_identifiers = set(malformed_identifiers)
+        self.bulk_upsert = bulk_upsert
+        self._random = random.Random(seed)
+        self._search_cache = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._create_request_handler())
+        self._server.daemon_threads = True
+        self.api_url = f"http://127.0.0.1:{self._server.server_port}"
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_entity(self, blueprint_id, identifier, datasource):
+        with self._lock:
+            self.entities[(blueprint_id, identifier)] = {'identifier': identifier, 'blueprint': blueprint_id,
+                                                         'datasource': datasource}
+            self._search_cache.clear()
+
+    def _upsert_entity(self, blueprint_id, entity, datasource):
+        # Returns whether the entity is valid
+        if entity['identifier'] in self.invalid_identifiers or entity['identifier'] in self.malformed_identifiers:
+            return False
+        self.add_entity(blueprint_id, entity['identifier'], datasource)
+        upserted_at = time.monotonic()
+        with self._lock:
+            self.upserts += 1
+            self.upserted_at.setdefault(entity['identifier'], upserted_at)
+        return True
+
+    def _is_throttled(self):
+        with self._lock:
+            self.requests += 1
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+        time.sleep(self.latency)
+        return throttled
+
+    def _search(self, blueprint_id, values):
+        # The sorted identifiers are cached between the pages of a search, until the entities change
+        with self._lock:
+            search_key = (blueprint_id, tuple(values))
+            if search_key not in self._search_cache:
+                self._search_cache[search_key] = sorted(
+                    identifier for (entity_blueprint_id, identifier), entity in self.entities.items() if
+                    entity_blueprint_id == blueprint_id and all(value in (entity['datasource'] or '')
+                                                                for value in values))
+            return self._search_cache[search_key]
+
+    def _create_request_handler(self):
+        port_server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Otherwise the delayed ACKs of the kept alive connections add 40ms to every request
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if port_server._is_throttled():
+                    return self._send(429, {}, {'Retry-After': '0.1'})
+                path = self.path.split('?')[0]
+                if path.endswith('/blueprints'):
+                    with port_server._lock:
+                        blueprint_ids = sorted({blueprint_id for blueprint_id, _ in port_server.entities})
+                    return self._send(200, {'blueprints': [{'identifier': blueprint_id}
+                                                           for blueprint_id in blueprint_ids]})
+                self._send(404, {})
+
+            def do_POST(self):
+                path = self.path.split('?')[0].split('/')
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                if path[-2:] == ['auth', 'access_token']:
+                    return self._send(200, {'accessToken': 'token', 'expiresIn': 3600})
+                if port_server._is_throttled():
+                    return self._send(429, {}, {'Retry-After': '0.1'})
+                if path[-1] == 'search':
+                    return self._search_page(path[-3], body)
+                if path[-1] == 'entities':
+                    if not port_server._upsert_entity(path[-2], body, self.headers.get('User-Agent')):
+                        return self._send(422, {'ok': False, 'error': 'invalid_entity'})
+                    return self._send(200, {'ok': True})
+                if path[-2:] == ['entities', 'bulk'] and port_server.bulk_upsert:
+                    with port_server._lock:
+                        port_server.bulk_upserts += 1
+                    if any(entity['identifier'] in port_server.malformed_identifiers for entity in body['entities']):
+                        return self._send(400, {'ok': False, 'error': 'invalid_request'})
+                    results = {'entities': [], 'errors': []}
+                    for index, entity in enumerate(body['entities']):
+                        if port_server._upsert_entity(path[-3], entity, self.headers.get('User-Agent')):
+                            results['entities'].append({'identifier': entity['identifier'], 'index': index})
+                        else:
+                            results['errors'].append({'identifier': entity['identifier'], 'index': index,
+                                                      'statusCode': 422, 'error': 'invalid_entity'})
+                    return self._send(207 if results['errors'] else 200, {'ok': True, **results})
+                self._send(404, {'ok': False, 'error': 'not_found'})
+
+            def do_DELETE(self):
+                if port_server._is_throttled():
+                    return self._send(429, {}, {'Retry-After': '0.1'})
+                path = self.path.split('?')[0].split('/')
+                with port_server._lock:
+                    port_server.deletes += 1
+                    entity = port_server.entities.pop((path[-3], path[-1]), None)
+                    port_server._search_cache.clear()
+                self._send(200 if entity else 404, {})
+
+            def _search_page(self, blueprint_id, body):
+                # Only the datasource rules of the exporter are supported
+                identifiers = port_server._search(blueprint_id, [rule['value'] for rule in
+                                                                 body.get('query', {}).get('rules', [])])
+                start = int(body.get('from') or 0)
+                end = start + body.get('limit', len(identifiers))
+                self._send(200, {'entities': [{'blueprint': blueprint_id, 'identifier': identifier}
+                                              for identifier in identifiers[start:end]],
+                                 'next': str(end) if end < len(identifiers) else None})
+
+            def _send(self, status_code, response, headers=None):
+                response_body = json.dumps(response).encode()
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response_body)))
+                for header, value in (headers or {}).items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(response_body)
+
+        return RequestHandler
+
+
+def install_clients(clients):
+    # Pre-populates the shared clients cache, so get_client returns the stand-ins instead of creating boto3 clients.
+    # clients is a dict of (service name, region) or (service name, region, role ARN) to client. The session of a
+    # role is created by aws.clients as usual, which assumes the role with the ('sts', None) stand-in, that has to be
+    # installed first, and the stand-ins of the role use its refreshable credentials
+    with aws.clients._lock:
+        for client_key, client in sorted(clients.items(), key=lambda item: len(item[0]) > 2 and item[0][2] is not None):
+            service_name, region_name, role_arn = (*client_key, None)[:3]
+            if role_arn:
+                client.credentials = aws.clients._get_session(role_arn).get_credentials()
+            aws.clients._clients[(service_name, region_name, role_arn)] = client
@@ -0,0 +1,32 @@
+# Measures the per-resource overhead of creating a boto3 client for every resource, compared to the shared
+# client cache. Runs offline, as creating a client doesn't call AWS.
+# Usage: python scripts/measure_client_overhead.py [resources count]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_function'))
+
+import boto3  # noqa: E402
+
+from aws.clients import get_client  # noqa: E402
+
+resources_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+region = os.getenv('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def measure(create_client):
+    start_time = time.perf_counter()
+    for _ in range(resources_count):
+        create_client()
+    return (time.perf_counter() - start_time) * 1000 / resources_count
+
+
+uncached_ms = measure(lambda: boto3.client('cloudcontrol', region_name=region))
+cached_ms = measure(lambda: get_client('cloudcontrol', region_name=region))
+
+print(f"resources: {resources_count}")
+print(f"boto3.client per resource: {uncached_ms:.3f}ms per resource")
+print(f"shared client cache: {cached_ms:.3f}ms per resource")
+print(f"overhead removed: {uncached_ms - cached_ms:.3f}ms per resource"
+      f" ({(uncached_ms - cached_ms) * 100000 / 1000:.1f}s per 100k resources)")
@@ -0,0 +1,58 @@
+# Measures the memory and the merge time of the entities that were seen in a sync, kept as a set of
+# "blueprint;identifier" strings compared to EntitySet. The entities are split to shards, that are merged like the
+# shard results of a fan out sync or the results of the handlers. Runs offline.
+# Usage: python scripts/measure_entity_set.py [entities count] [shards count]
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lambda_function'))
+
+from port.entity_set import EntitySet  # noqa: E402
+
+entities_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+shards_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+blueprints = ['ec2Instance', 's3Bucket', 'lambdaFunction', 'rdsInstance']
+
+
+def get_shard_entity_keys(shard_id):
+    return [f"{blueprints[index % len(blueprints)]};arn:aws:ec2:us-east-1:123456789012:instance/i-{index:017x}"
+            for index in range(shard_id, entities_count, shards_count)]
+
+
+def merge_shards(create_entities):
+    shards = [create_entities(get_shard_entity_keys(shard_id)) for shard_id in range(shards_count)]
+    start_time = time.perf_counter()
+    entities = create_entities(())
+    for shard_entities in shards:
+        entities.update(shard_entities)
+    len(entities)  # Counted before the stale entities are deleted, which completes the merge of EntitySet
+    return entities, (time.perf_counter() - start_time) * 1000
+
+
+def measure(create_entities):
+    # Tracing slows down the allocations, so the time is measured in a separate run
+    tracemalloc.start()
+    entities, _ = merge_shards(create_entities)
+    memory_mb = tracemalloc.get_traced_memory()[0] / (1024 * 1024)
+    tracemalloc.stop()
+    entities, merge_ms = merge_shards(create_entities)
+
+    lookup_entity_keys = get_shard_entity_keys(0)
+    start_time = time.perf_counter()
+    missing_count = sum(1 for entity_key in lookup_entity_keys if entity_key not in entities)
+    lookup_us = (time.perf_counter() - start_time) * 1000000 / len(lookup_entity_keys)
+    assert len(entities) == entities_count and missing_count == 0
+    return memory_mb, merge_ms, lookup_us
+
+
+set_memory_mb, set_merge_ms, set_lookup_us = measure(set)
+entity_set_memory_mb, entity_set_merge_ms, entity_set_lookup_us = measure(EntitySet)
+
+print(f"entities: {entities_count}, shards: {shards_count}")
+print(f"set of strings: {set_memory_mb:.1f}MB, merge: {set_merge_ms:.0f}ms, lookup: {set_lookup_us:.2f}us")
+print(f"EntitySet: {entity_set_memory_mb:.1f}MB, merge: {entity_set_merge_ms:.0f}ms,"
+      f" lookup: {entity_set_lookup_us:.2f}us")
+print(f"memory saved: {set_memory_mb - entity_set_memory_mb:.1f}MB"
+      f" ({(1 - entity_set_memory_mb / set_memory_mb) * 100:.0f}%)")
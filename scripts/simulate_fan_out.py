@@ -0,0 +1,86 @@
+# Runs a whole sync locally against in-process stand-ins for S3, Secrets Manager, Lambda, Cloud Control and the
+# Port API, either as a fan out sync or as the sequential re-invocation chain, and reports how it went.
+# All the invocations share one process, and so its concurrency limiters, so the elapsed time isn't representative
+# of separate Lambda workers.
+# Usage: python scripts/simulate_fan_out.py [--sequential] [--fail-shard ID] [--budget SECONDS]
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from local_stand_ins import FakeS3, FakeSecretsManager, FakeCloudControl, FakeLambda, FakePortServer, \
+    install_clients  # noqa: E402
+
+BUCKET_NAME = 'exporter-bucket'
+CONFIG_JSON_FILE_KEY = 'exporter/config.json'
+FUNCTION_NAME = 'port-aws-exporter'
+KINDS = ['AWS::S3::Bucket', 'AWS::EC2::Instance', 'AWS::Lambda::Function', 'AWS::SQS::Queue']
+REGIONS = ['us-east-1', 'eu-west-1', 'ap-south-1']
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sequential', action='store_true', help="Disable fan out, and sync with one invocation chain")
+parser.add_argument('--fail-shard', type=int, help="Fail the first invocation of this shard")
+parser.add_argument('--budget', type=float, default=30, help="Seconds that every invocation gets")
+parser.add_argument('--resources', type=int, default=300, help="Resources of every kind in every region")
+parser.add_argument('--latency', type=float, default=0.05, help="Seconds that every Cloud Control call takes")
+parser.add_argument('--stale', type=int, default=20, help="Stale entities in Port before the sync")
+parser.add_argument('--verbose', action='store_true')
+args = parser.parse_args()
+
+os.environ.update(BUCKET_NAME=BUCKET_NAME, CONFIG_JSON_FILE_KEY=CONFIG_JSON_FILE_KEY, PORT_CREDS_SECRET_ARN='secret')
+port_server = FakePortServer().start()
+s3 = FakeS3()
+cloudcontrol_clients = {region: FakeCloudControl(region, {kind: args.resources for kind in KINDS}, latency=args.latency)
+                        for region in REGIONS}
+install_clients({('s3', None): s3, ('secretsmanager', None): FakeSecretsManager('client-id', 'client-secret'),
+                 **{('cloudcontrol', region): client for region, client in cloudcontrol_clients.items()}})
+
+import app  # noqa: E402
+import consts  # noqa: E402
+
+logging.basicConfig(format='%(asctime)s %(threadName)s %(name)s %(message)s')
+logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+consts.REMAINING_TIME_TO_REINVOKE_THRESHOLD = 1000
+consts.DEFAULT_PAGE_LATENCY = consts.DEFAULT_ITEM_LATENCY = args.latency
+consts.MIN_REMAINING_TIME_TO_DELETE_STALE_RESOURCES = 1000
+
+
+def fail_shard(event):
+    failed = args.fail_shard is not None and f"/shards/{args.fail_shard}/" in event.get('next_config_file_key', '')
+    if failed:
+        args.fail_shard = None  # Only the first invocation fails, as if the invocation was lost
+    return failed
+
+
+lambda_client = FakeLambda(app.lambda_handler, FUNCTION_NAME, args.budget, fail_payload=fail_shard)
+install_clients({('lambda', None): lambda_client})
+
+config = {'port_api_url': port_server.api_url, 'fan_out': {'enabled': not args.sequential},
+          'resources': [{'kind': kind, 'selector': {'aws': {'regions': REGIONS}},
+                         'port': {'entity': {'mappings': [{'identifier': '.Identifier', 'title': '.Identifier',
+                                                           'blueprint': f'"{kind.split("::")[-1].lower()}"',
+                                                           'properties': {'arn': '.Arn'}}]}}} for kind in KINDS]}
+s3.put_object(Body=json.dumps(config), Bucket=BUCKET_NAME, Key=CONFIG_JSON_FILE_KEY)
+
+datasource = f"{consts.PORT_AWS_EXPORTER_NAME}/0.1 (accountid/123456789012 region/us-east-1)"
+for stale_index in range(args.stale):
+    port_server.add_entity('bucket', f"stale-{stale_index}", datasource)
+
+start_time = time.monotonic()
+lambda_client.run({})
+lambda_client.wait()
+elapsed = time.monotonic() - start_time
+
+expected_entities = len(KINDS) * len(REGIONS) * args.resources
+stale_left = sum(1 for _, identifier in port_server.entities if identifier.startswith('stale-'))
+print(f"mode: {'sequential' if args.sequential else 'fan out'}, elapsed: {elapsed:.2f}s,"
+      f" invocations: {lambda_client.invocations}, errors: {len(lambda_client.errors)}")
+print(f"upserts: {port_server.upserts}/{expected_entities}, deletes: {port_server.deletes},"
+      f" stale left: {stale_left}/{args.stale}, entities: {len(port_server.entities)}")
+print(f"cloud control calls: {sum(client.calls for client in cloudcontrol_clients.values())},"
+      f" s3 objects left: {[key for key in s3.keys(BUCKET_NAME) if key != CONFIG_JSON_FILE_KEY]}")
+port_server.stop()